@@ -12,13 +12,18 @@ if __name__ == '__main__':
                         default="cot", help="cot or io.")
     parser.add_argument("--max_length", type=int,
                         default=256, help="the max length of LLMs output.")
-    parser.add_argument("--temperature", type=int,
+    parser.add_argument("--temperature", type=float,
                         default=0, help="the temperature")
-    parser.add_argument("--LLM_type", type=int,
+    parser.add_argument("--LLM_type", type=str,
                         default="gpt-3.5-turbo", help="base LLM model.")
-    parser.add_argument("--opeani_api_keys", type=int,
+    parser.add_argument("--opeani_api_keys", type=str,
                         default="", help="if the LLM_type is gpt-3.5-turbo or gpt-4, you need add your own openai api keys.")
+    parser.add_argument("--llm_backend", type=str,
+                        default="auto", help="LLM backend, can be openai, local (OpenAI-compatible local server), mock (offline deterministic) or auto (local for llama, openai otherwise).")
+    parser.add_argument("--llm_api_base", type=str,
+                        default="", help="base url of the LLM backend, empty for the backend default.")
     args = parser.parse_args()
+    setup_llm(args)
 
 with open("cot_{}.jsonl".format(args.dataset), 'a+', encoding="UTF-8") as out:
     datas, question_string = prepare_dataset(args.dataset)
@@ -29,3 +34,4 @@ with open("cot_{}.jsonl".format(args.dataset), 'a+', encoding="UTF-8") as out:
             prompt = io_prompt + "\n\nQ: " + i[question_string] + "\nA: "
         results = run_llm(prompt, args.temperature, args.max_length, args.opeani_api_keys, args.LLM_type)
         out.write(json.dumps({"question": i[question_string], "{}_result".format(args.prompt_methods): results})+'\n')
+close_llm()
@@ -1,35 +1,26 @@
-import openai
-import time
+import os
+import sys
 import json
 
-def run_llm(prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
-    if "llama" not in engine.lower():
-        openai.api_key = "EMPTY"
-        openai.api_base = "http://localhost:8000/v1"  # your local llama server port
-        engine = openai.Model.list()["data"][0]["id"]
-    else:
-        openai.api_key = opeani_api_keys
+# the LLM client and backends are shared with ToG
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ToG"))
+from llm_client import llm_client
+from llm_backends import get_backend
+
+
+def setup_llm(args):
+    backend = get_backend(args.llm_backend, args.LLM_type, args.llm_api_base)
+    llm_client.configure(backend=backend)
+    # resolve the served model once at startup instead of on every call
+    llm_client.run_sync(backend.resolve_model(args.LLM_type))
 
-    messages = [{"role":"system","content":"You are an AI assistant that helps people find information."}]
-    message_prompt = {"role":"user","content":prompt}
-    messages.append(message_prompt)
-    print("start openai")
-    while(f == 0):
-        try:
-            response = openai.ChatCompletion.create(
-                    model=engine,
-                    messages = messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    frequency_penalty=0,
-                    presence_penalty=0)
-            result = response["choices"][0]['message']['content']
-            f = 1
-        except:
-            print("openai error, retry")
-            time.sleep(2)
-    print("end openai")
-    return result
+
+def close_llm():
+    llm_client.run_sync(llm_client.close())
+
+
+def run_llm(prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
+    return llm_client.run_sync(llm_client.run_llm(prompt, temperature, max_tokens, opeani_api_keys, engine))
 
 def prepare_dataset(dataset_name):
     if dataset_name == 'cwq':
@@ -0,0 +1,102 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+import freebase_func
+from freebase_func import *
+from kg_store import KGStore
+from stats import percentile
+
+_store = None  # KG store of a worker process, None for the Virtuoso path
+
+
+def _init_worker(kg_store_path, sparql_endpoints):
+    global _store
+    if kg_store_path:
+        _store = KGStore(kg_store_path)
+    elif sparql_endpoints:
+        freebase_func.sparql_client = SPARQLClient(sparql_endpoints.split(","))
+
+
+def _pick_relations(head_relations, tail_relations, n_relations):
+    relations = [(relation, True) for relation in sorted(set(head_relations))] + [(relation, False) for relation in sorted(set(tail_relations))]
+    return [(relation, head) for relation, head in relations if not abandon_rels(relation)][:n_relations]
+
+
+def store_step(store, entity, n_relations, n_names):
+    """One search step of `entity` (relations, entities of `n_relations` of them, names of `n_names` of those) on the store, returns its number of lookups."""
+    head_relations, tail_relations = store.relations(entity)
+    lookups = 2
+    for relation, head in _pick_relations(head_relations, tail_relations, n_relations):
+        entity_ids = [entity_id for entity_id in store.neighbours(entity, relation, head) if entity_id.startswith("m.")]
+        lookups += 1
+        if entity_ids:
+            store.names(entity_ids[:n_names])
+            lookups += 1
+    return lookups
+
+
+def sparql_step(entity, n_relations, n_names):
+    """`store_step` with the SPARQL templates of the search, the SPARQL cache bypassed, returns its number of queries."""
+    head_relations = replace_relation_prefix(execurte_sparql(sparql_head_relations % entity, cache=False))
+    tail_relations = replace_relation_prefix(execurte_sparql(sparql_tail_relations % entity, cache=False))
+    queries = 2
+    for relation, head in _pick_relations(head_relations, tail_relations, n_relations):
+        query = sparql_tail_entities_extract % (entity, relation) if head else sparql_head_entities_extract % (relation, entity)
+        entity_ids = [entity_id for entity_id in replace_entities_prefix(execurte_sparql(query, cache=False)) if entity_id.startswith("m.")]
+        queries += 1
+        if entity_ids:
+            execurte_sparql(sparql_ids % " ".join("ns:" + entity_id for entity_id in entity_ids[:n_names]), cache=False)
+            queries += 1
+    return queries
+
+
+def _run_step(task):
+    entity, n_relations, n_names = task
+    started = time.perf_counter()
+    if _store is not None:
+        lookups = store_step(_store, entity, n_relations, n_names)
+    else:
+        lookups = sparql_step(entity, n_relations, n_names)
+    return lookups, time.perf_counter() - started
+
+
+def benchmark(name, entities, processes, kg_store_path, sparql_endpoints, n_relations, n_names):
+    started = time.perf_counter()
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(kg_store_path, sparql_endpoints)) as executor:
+        results = list(executor.map(_run_step, [(entity, n_relations, n_names) for entity in entities], chunksize=16))
+    elapsed = time.perf_counter() - started
+    lookups = sum(n for n, _ in results)
+    latencies = [latency * 1000 for _, latency in results]
+    print("%s: %d entities, %d lookups in %.2fs with %d processes, %.0f lookups/s, per entity p50 %.2fms, p95 %.2fms." % (
+        name, len(entities), lookups, elapsed, processes, lookups / elapsed, percentile(latencies, 50), percentile(latencies, 95)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of the search lookups on a KG store (build_kg_index.py, extract_subgraph.py) against Virtuoso.")
+    parser.add_argument("--kg_store", type=str,
+                        required=True, help="directory of the store.")
+    parser.add_argument("--dataset", type=str,
+                        default="cwq", help="dataset whose topic entities are looked up.")
+    parser.add_argument("--num_entities", type=int,
+                        default=1000, help="topic entities looked up, the list is repeated to reach it.")
+    parser.add_argument("--relations_per_entity", type=int,
+                        default=5, help="relations of each entity whose entities are looked up.")
+    parser.add_argument("--names_per_relation", type=int,
+                        default=10, help="entities of each relation whose names are looked up.")
+    parser.add_argument("--processes", type=int,
+                        default=1, help="worker processes, they share the pages of the store.")
+    parser.add_argument("--sparql_endpoints", type=str,
+                        default="", help="comma separated SPARQL endpoints, empty for $SPARQL_ENDPOINTS or SPARQLPATH.")
+    parser.add_argument("--skip_sparql", action="store_true",
+                        help="only benchmark the store.")
+    args = parser.parse_args()
+
+    datas, _ = prepare_dataset(args.dataset)
+    topic_entities = list(dict.fromkeys(entity for data in datas for entity in data['topic_entity']))
+    entities = [topic_entities[i % len(topic_entities)] for i in range(args.num_entities)]
+    started = time.perf_counter()
+    store = KGStore(args.kg_store)
+    print("KG store %s opened in %.1fms: %s" % (args.kg_store, (time.perf_counter() - started) * 1000, store.stats()))
+    benchmark("KG store", entities, args.processes, args.kg_store, "", args.relations_per_entity, args.names_per_relation)
+    if not args.skip_sparql:
+        benchmark("Virtuoso", entities, args.processes, "", args.sparql_endpoints, args.relations_per_entity, args.names_per_relation)
@@ -0,0 +1,162 @@
+import argparse
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from tqdm import tqdm
+from kg_store import LITERAL, NAME_RELATIONS, open_dump, parse_ntriple, write_csr, write_meta, write_strings
+
+MAX_RUNS = 256  # runs merged at once, below the usual limit of open files
+
+
+class ExternalSorter:
+    """
+    Sorts more records than fit in memory.
+
+    Records (tuples of str and int, the str fields without tabs or newlines) are buffered and
+    written to `tmp_dir` as sorted runs of `chunk_size` records, which are merged when iterated.
+    Memory is bounded by `chunk_size` whatever the number of records.
+    """
+
+    def __init__(self, tmp_dir, name, chunk_size, types):
+        self.tmp_dir = tmp_dir
+        self.name = name
+        self.chunk_size = chunk_size
+        self.types = types
+        self.buffer = []
+        self.runs = []
+        self.n_written = 0
+
+    def add(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunk_size:
+            self.buffer.sort()
+            self._write_run(self.buffer)
+            self.buffer = []
+
+    def _write_run(self, records):
+        path = os.path.join(self.tmp_dir, "%s.%d" % (self.name, self.n_written))
+        self.n_written += 1
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines("\t".join(map(str, record)) + "\n" for record in records)
+        self.runs.append(path)
+        if len(self.runs) >= MAX_RUNS:
+            # merge the runs into a single one so that the final merge keeps few files open
+            runs, self.runs = self.runs, []
+            self._write_run(heapq.merge(*map(self._read_run, runs)))
+            for run in runs:
+                os.remove(run)
+
+    def _read_run(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                yield tuple(t(field) for t, field in zip(self.types, line[:-1].split("\t")))
+
+    def __iter__(self):
+        """Records in sorted order, without duplicates."""
+        self.buffer.sort()
+        previous = None
+        for record in heapq.merge(*map(self._read_run, self.runs), self.buffer):
+            if record != previous:
+                yield record
+            previous = record
+
+
+def _join_nodes(records, path):
+    """(node id, record) of records sorted by a node in their first field, the ids read in order from the nodes of the store."""
+    with open(os.path.join(path, "nodes.txt"), encoding="utf-8") as f:
+        node_id, node = -1, None
+        for record in records:
+            while node != record[0]:
+                line = f.readline()
+                if not line:
+                    raise ValueError("node %s is missing from %s." % (record[0], path))
+                node, node_id = line[:-1], node_id + 1
+            yield node_id, record
+
+
+def _node_names(names, path):
+    """JSON name of each node of the store in order, the first of `names` sorted by (node, preference, dump line), null if none."""
+    names = iter(names)
+    record = next(names, None)
+    with open(os.path.join(path, "nodes.txt"), encoding="utf-8") as f:
+        for line in f:
+            node = line[:-1]
+            name = "null"
+            if record is not None and record[0] == node:
+                name = record[3]
+            while record is not None and record[0] == node:
+                record = next(names, None)
+            yield name
+
+
+def build_index(dump_path, output, chunk_size, tmp_dir=""):
+    """
+    Write the KG store of a whole filtered Freebase dump (`kg_store.py` format) with bounded memory.
+
+    One pass over the dump spills the terms, the triples and the names into sorted runs. The merged
+    terms give the node dictionary, then two merge joins of the triples with it (sorted by subject,
+    then by object) encode them as ids, and the encoded edges are sorted again per direction into
+    the CSR arrays. Only the predicate table is held in memory whole.
+    """
+    os.makedirs(output, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="kg_index_", dir=tmp_dir or output)
+    try:
+        terms = ExternalSorter(work_dir, "terms", chunk_size, (str,))
+        triples = ExternalSorter(work_dir, "triples", chunk_size, (str, str, str))  # (subject, relation, object, "" for a value)
+        names = ExternalSorter(work_dir, "names", chunk_size, (str, int, int, str))  # (node, preference, dump line, JSON name)
+        relations = set()
+        with open_dump(dump_path) as f:
+            for line_number, line in enumerate(tqdm(f, desc="reading the dump")):
+                triple = parse_ntriple(line)
+                if triple is None:
+                    continue
+                subject, relation, obj, is_uri = triple
+                relations.add(relation)
+                terms.add((subject,))
+                if is_uri:
+                    terms.add((obj,))
+                triples.add((subject, relation, obj if is_uri else ""))
+                if relation in NAME_RELATIONS:
+                    names.add((subject, NAME_RELATIONS.index(relation), line_number, json.dumps(obj)))
+
+        n_nodes = write_strings(output, "nodes", (node for node, in tqdm(terms, desc="node dictionary")))
+        relations = sorted(relations)
+        write_strings(output, "relations", relations)
+        relation_ids = {relation: i for i, relation in enumerate(relations)}
+
+        by_object = ExternalSorter(work_dir, "by_object", chunk_size, (str, int, int))  # (object, subject id, relation id)
+        out_edges = ExternalSorter(work_dir, "out", chunk_size, (int, int, int))
+        in_edges = ExternalSorter(work_dir, "in", chunk_size, (int, int, int))
+        for subject_id, (_, relation, obj) in tqdm(_join_nodes(triples, output), desc="encoding subjects"):
+            if obj:
+                by_object.add((obj, subject_id, relation_ids[relation]))
+            else:
+                out_edges.add((subject_id, relation_ids[relation], LITERAL))
+        for object_id, (_, subject_id, relation_id) in tqdm(_join_nodes(by_object, output), desc="encoding objects"):
+            out_edges.add((subject_id, relation_id, object_id))
+            in_edges.add((object_id, relation_id, subject_id))
+        n_edges = write_csr(output, "out", n_nodes, tqdm(out_edges, desc="out CSR"))
+        write_csr(output, "in", n_nodes, tqdm(in_edges, desc="in CSR"))
+        write_strings(output, "names", _node_names(names, output))
+        write_meta(output, n_nodes, len(relations), n_edges, dump_path)
+    finally:
+        shutil.rmtree(work_dir)
+    return n_nodes, len(relations), n_edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the memory-mapped KG store of a whole filtered Freebase dump (--kg_store of main_freebase.py).")
+    parser.add_argument("--dump", type=str,
+                        required=True, help="filtered Freebase N-Triples dump, plain or .gz.")
+    parser.add_argument("--output", type=str,
+                        required=True, help="directory of the store.")
+    parser.add_argument("--chunk_size", type=int,
+                        default=5000000, help="records sorted in memory at once, bounds the memory of the build (about 1GB per million).")
+    parser.add_argument("--tmp_dir", type=str,
+                        default="", help="directory of the sorted runs, about three times the size of the dump, empty for a directory inside --output.")
+    args = parser.parse_args()
+
+    n_nodes, n_relations, n_edges = build_index(args.dump, args.output, args.chunk_size, args.tmp_dir)
+    print("KG store %s: %d nodes, %d relations, %d edges." % (args.output, n_nodes, n_relations, n_edges))
@@ -1,4 +1,5 @@
 import itertools
+import threading
 import xmlrpc.client
 import typing as tp
 from dataclasses import dataclass
@@ -11,7 +12,14 @@ from bs4 import BeautifulSoup
 class WikidataQueryClient:
     def __init__(self, url: str):
         self.url = url
-        self.server = xmlrpc.client.ServerProxy(url)
+        self._local = threading.local()
+
+    @property
+    def server(self) -> xmlrpc.client.ServerProxy:
+        # a ServerProxy keeps one HTTP connection and is not thread safe, so each thread gets its own
+        if not hasattr(self._local, "server"):
+            self._local.server = xmlrpc.client.ServerProxy(self.url)
+        return self._local.server
 
     def label2qid(self, label: str) -> str:
         return self.server.label2qid(label)
@@ -101,9 +109,12 @@ from concurrent.futures import ThreadPoolExecutor
 
 
 class MultiServerWikidataQueryClient:
-    def __init__(self, urls: tp.List[str]):
+    def __init__(self, urls: tp.List[str], max_workers: int = None, cache=None):
         self.clients = [WikidataQueryClient(url) for url in urls]
-        self.executor = ThreadPoolExecutor(max_workers=len(urls))
+        # optional `kg_cache.KGCache`, looked up before the servers are queried
+        self.cache = cache
+        # one thread per server for each query issued at the same time
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(urls))
         # # test connections
         # start_time = time.perf_counter()
         # self.test_connections()
@@ -135,21 +146,38 @@ class MultiServerWikidataQueryClient:
             raise Exception("Failed to connect to all URLs")
 
     def query_all(self, method, *args):
-        start_time = time.perf_counter()
+        if self.cache is not None:
+            cached = self.cache.get(method, *args)
+            if cached is not None:
+                return cached
         futures = [
             self.executor.submit(getattr(client, method), *args)
             for client in self.clients
         ]
-        # Retrieve results and filter out 'Not Found!'
+        return self.merge_results(method, [f.result() for f in futures])
+
+    def query_many(self, method, args_list):
+        """`query_all` for many argument tuples, sent as one XML-RPC multicall per server."""
+
+        def call(client):
+            multicall = xmlrpc.client.MultiCall(client.server)
+            for args in args_list:
+                getattr(multicall, method)(*args)
+            return list(multicall())
+
+        results = list(self.executor.map(call, self.clients))
+        return [
+            self.merge_results(method, [res[i] for res in results])
+            for i in range(len(args_list))
+        ]
+
+    @staticmethod
+    def merge_results(method, results):
+        # Filter out 'Not Found!' and merge the answers of the servers
         is_dict_return = method in [
             "get_all_relations_of_an_entity",
             "get_tail_entities_given_head_and_relation",
         ]
-        results = [f.result() for f in futures]
-        end_time = time.perf_counter()
-        # print(f"HTTP Queries took {end_time - start_time} seconds")
-
-        start_time = time.perf_counter()
         real_results = (
             set() if not is_dict_return else {"head": [], "tail": []}
         )
@@ -169,8 +197,6 @@ class MultiServerWikidataQueryClient:
                 real_results["tail"].extend(res["tail"])
             else:
                 real_results.add(res)
-        end_time = time.perf_counter()
-        # print(f"Querying all took {end_time - start_time} seconds")
 
         return real_results if len(real_results) > 0 else "Not Found!"
 
@@ -0,0 +1,145 @@
+import argparse
+from collections import defaultdict
+import freebase_func
+from freebase_func import *
+from kg_store import FREEBASE_NS, NAME_RELATIONS, open_dump, parse_ntriple, write_store
+
+
+class SubgraphCollector:
+    """Edges kept for the store, at most `max_degree` per node and direction plus one for each further relation."""
+
+    def __init__(self, max_degree):
+        self.max_degree = max_degree
+        self.triples = set()
+        self.names = {}
+        self.degree = defaultdict(int)
+        self.truncated = defaultdict(set)
+
+    def add(self, node, head, subject, relation, obj):
+        key = (node, head)
+        if self.degree[key] >= self.max_degree:
+            # past the cap only the relation is kept, so that the relation lists stay complete
+            if relation in self.truncated[key]:
+                return False
+            self.truncated[key].add(relation)
+        self.degree[key] += 1
+        self.triples.add((subject, relation, obj))
+        return True
+
+    def add_name(self, node, relation, value):
+        # type.object.name wins over sameAs, the first value of a relation is kept
+        current = self.names.get(node)
+        if current is None or (relation == NAME_RELATIONS[0] and current[0] != NAME_RELATIONS[0]):
+            self.names[node] = (relation, value)
+
+
+def extract_from_dump(path, topic_entities, hops, max_degree):
+    """
+    Keep the edges of the entities within `hops` - 1 hops of the topic entities, one pass over the dump per hop.
+
+    A last pass collects the names of the entities at `hops` hops. Only entities (m.) are expanded.
+    """
+    collector = SubgraphCollector(max_degree)
+    frontier = set(topic_entities)
+    seen = set(frontier)
+    for hop in range(hops + 1):
+        last = hop == hops
+        reached = set()
+        with open_dump(path) as f:
+            for line in tqdm(f, desc="dump pass %d/%d" % (hop + 1, hops + 1)):
+                triple = parse_ntriple(line)
+                if triple is None:
+                    continue
+                subject, relation, obj, is_uri = triple
+                if relation in NAME_RELATIONS and subject in seen:
+                    collector.add_name(subject, relation, obj)
+                if last:
+                    continue
+                if subject in frontier:
+                    if collector.add(subject, True, subject, relation, obj if is_uri else None) and is_uri and obj.startswith("m.") and obj not in seen:
+                        reached.add(obj)
+                if is_uri and obj in frontier:
+                    if collector.add(obj, False, subject, relation, obj) and subject.startswith("m.") and subject not in seen:
+                        reached.add(subject)
+        seen |= reached
+        frontier = reached
+    return collector.triples, {node: value for node, (_, value) in collector.names.items()}
+
+
+sparql_sample_head_relations = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?relation (SAMPLE(?y) AS ?x)\nWHERE {\n  ns:%s ?relation ?y .\n}\nGROUP BY ?relation"""
+sparql_sample_tail_relations = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?relation (SAMPLE(?y) AS ?x)\nWHERE {\n  ?y ?relation ns:%s .\n}\nGROUP BY ?relation"""
+
+
+def _add_rows(entity_of, rows, head, collector, reached, seen):
+    strip = lambda value: value.replace(FREEBASE_NS, "")
+    for row in rows:
+        entity, relation, neighbour = entity_of(row), strip(row["relation"]["value"]), strip(row["x"]["value"])
+        is_uri = row["x"].get("type") == "uri"
+        triple = (entity, relation, neighbour if is_uri else None) if head else (neighbour, relation, entity)
+        if collector.add(entity, head, *triple) and is_uri and neighbour.startswith("m.") and neighbour not in seen:
+            reached.add(neighbour)
+
+
+def _query_edges(entities, head, max_degree, collector, reached, seen):
+    template = sparql_neighborhood_out if head else sparql_neighborhood_in
+    limit = max_degree * len(entities)
+    rows = execurte_sparql(template % (" ".join("ns:" + entity for entity in entities), limit))
+    if len(rows) >= limit and len(entities) > 1:
+        half = len(entities) // 2
+        _query_edges(entities[:half], head, max_degree, collector, reached, seen)
+        _query_edges(entities[half:], head, max_degree, collector, reached, seen)
+        return
+    _add_rows(lambda row: row["entity"]["value"].replace(FREEBASE_NS, ""), rows, head, collector, reached, seen)
+    if len(rows) >= limit:
+        # hub entity cut by the limit, one edge of each of its relations keeps the relation lists complete
+        entity = entities[0]
+        rows = execurte_sparql((sparql_sample_head_relations if head else sparql_sample_tail_relations) % entity)
+        _add_rows(lambda row: entity, rows, head, collector, reached, seen)
+
+
+def extract_from_sparql(topic_entities, hops, max_degree, batch_size):
+    """Same as `extract_from_dump` with the batched neighbourhood queries of the KG prefetch."""
+    collector = SubgraphCollector(max_degree)
+    frontier = sorted(set(topic_entities))
+    seen = set(frontier)
+    for hop in range(hops):
+        reached = set()
+        for start in tqdm(range(0, len(frontier), batch_size), desc="hop %d/%d" % (hop + 1, hops)):
+            batch = frontier[start:start + batch_size]
+            _query_edges(batch, True, max_degree, collector, reached, seen)
+            _query_edges(batch, False, max_degree, collector, reached, seen)
+        seen |= reached
+        frontier = sorted(reached)
+    nodes = sorted(node for node in seen if node.startswith("m."))
+    names = {node: name for node, name in zip(nodes, id2entity_names(nodes)) if name != "UnName_Entity"}
+    return collector.triples, names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract the neighbourhood of the topic entities of a dataset into a local KG store (--kg_store of main_freebase.py).")
+    parser.add_argument("--dataset", type=str,
+                        default="cwq", help="dataset whose topic entities are extracted, as in main_freebase.py.")
+    parser.add_argument("--output", type=str,
+                        required=True, help="directory of the store.")
+    parser.add_argument("--hops", type=int,
+                        default=3, help="search depth the store must serve, the edges of the entities up to hops - 1 away are kept, and the names of those up to hops away.")
+    parser.add_argument("--dump", type=str,
+                        default="", help="filtered Freebase N-Triples dump (plain or .gz) read instead of querying Virtuoso.")
+    parser.add_argument("--max_degree", type=int,
+                        default=1000, help="edges kept per entity and direction, further edges only keep their relation listed.")
+    parser.add_argument("--batch_size", type=int,
+                        default=50, help="entities per SPARQL query when extracting from Virtuoso.")
+    parser.add_argument("--sparql_endpoints", type=str,
+                        default="", help="comma separated SPARQL endpoints when extracting from Virtuoso, empty for $SPARQL_ENDPOINTS or SPARQLPATH.")
+    args = parser.parse_args()
+
+    datas, _ = prepare_dataset(args.dataset)
+    topic_entities = [entity for data in datas for entity in data['topic_entity']]
+    if args.dump:
+        triples, names = extract_from_dump(args.dump, topic_entities, args.hops, args.max_degree)
+    else:
+        if args.sparql_endpoints:
+            freebase_func.sparql_client = SPARQLClient(args.sparql_endpoints.split(","))
+        triples, names = extract_from_sparql(topic_entities, args.hops, args.max_degree, args.batch_size)
+    write_store(args.output, triples, names, source=args.dump or "sparql")
+    print("KG store %s: %d triples, %d names, %d topic entities." % (args.output, len(triples), len(names), len(set(topic_entities))))
@@ -1,14 +1,37 @@
-from SPARQLWrapper import SPARQLWrapper, JSON
+import os
+import random
+import threading
 from utils import *
+from frontier import Frontier
+from sparql_client import SPARQLClient
+from sparql_cache import SPARQLCache
+from kg_store import KGStore
 
 SPARQLPATH = "http://192.168.80.12:8890/sparql"  # depend on your own internal address and port, shown in Freebase folder's readme.md
+# comma separated endpoints of Virtuoso replicas, overridden by --sparql_endpoints
+sparql_client = SPARQLClient(os.environ.get("SPARQL_ENDPOINTS", SPARQLPATH).split(","))
+sparql_cache = None
+# local subgraph store answering the KG lookups instead of Virtuoso, see extract_subgraph.py
+kg_store = None
 
 # pre-defined sparqls
 sparql_head_relations = """\nPREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?relation\nWHERE {\n  ns:%s ?relation ?x .\n}"""
 sparql_tail_relations = """\nPREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?relation\nWHERE {\n  ?x ?relation ns:%s .\n}"""
 sparql_tail_entities_extract = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?tailEntity\nWHERE {\nns:%s ns:%s ?tailEntity .\n}""" 
 sparql_head_entities_extract = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?tailEntity\nWHERE {\n?tailEntity ns:%s ns:%s  .\n}"""
+sparql_tail_entities_capped = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?tailEntity ?name ?total\nWHERE {\n  {\n    SELECT (COUNT(?x) AS ?total)\n    WHERE {\n      ns:%s ns:%s ?x .\n      FILTER(STRSTARTS(STR(?x), "http://rdf.freebase.com/ns/m."))\n    }\n  }\n  {\n    SELECT ?tailEntity\n    WHERE {\n      ns:%s ns:%s ?tailEntity .\n      FILTER(STRSTARTS(STR(?tailEntity), "http://rdf.freebase.com/ns/m."))\n    }\n    %sLIMIT %d\n  }\n  OPTIONAL {\n    ?tailEntity ns:type.object.name ?name .\n  }\n}"""
+sparql_head_entities_capped = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?tailEntity ?name ?total\nWHERE {\n  {\n    SELECT (COUNT(?x) AS ?total)\n    WHERE {\n      ?x ns:%s ns:%s .\n      FILTER(STRSTARTS(STR(?x), "http://rdf.freebase.com/ns/m."))\n    }\n  }\n  {\n    SELECT ?tailEntity\n    WHERE {\n      ?tailEntity ns:%s ns:%s .\n      FILTER(STRSTARTS(STR(?tailEntity), "http://rdf.freebase.com/ns/m."))\n    }\n    %sLIMIT %d\n  }\n  OPTIONAL {\n    ?tailEntity ns:type.object.name ?name .\n  }\n}"""
+sparql_tail_entities_compound = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?relation ?tailEntity ?name\nWHERE {\n  {\n    ns:%s ns:%s ?tailEntity .\n    ?tailEntity ns:type.object.name ?name .\n  }\n  UNION\n  {\n    ns:%s ns:%s ?cvt .\n    FILTER NOT EXISTS { ?cvt ns:type.object.name ?cvtName }\n    ?cvt ?relation ?tailEntity .\n    ?tailEntity ns:type.object.name ?name .\n    FILTER(?tailEntity != ns:%s)\n%s  }\n  FILTER(STRSTARTS(STR(?tailEntity), "http://rdf.freebase.com/ns/m."))\n}\nLIMIT %d"""
+sparql_head_entities_compound = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?relation ?tailEntity ?name\nWHERE {\n  {\n    ?tailEntity ns:%s ns:%s .\n    ?tailEntity ns:type.object.name ?name .\n  }\n  UNION\n  {\n    ?cvt ns:%s ns:%s .\n    FILTER NOT EXISTS { ?cvt ns:type.object.name ?cvtName }\n    ?cvt ?relation ?tailEntity .\n    ?tailEntity ns:type.object.name ?name .\n    FILTER(?tailEntity != ns:%s)\n%s  }\n  FILTER(STRSTARTS(STR(?tailEntity), "http://rdf.freebase.com/ns/m."))\n}\nLIMIT %d"""
+sparql_neighborhood_out = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?entity ?relation ?x\nWHERE {\n  VALUES ?entity { %s }\n  ?entity ?relation ?x .\n}\nLIMIT %d"""
+sparql_neighborhood_in = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT ?entity ?relation ?x\nWHERE {\n  VALUES ?entity { %s }\n  ?x ?relation ?entity .\n}\nLIMIT %d"""
+sparql_distinct_head_relations = """\nPREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?relation\nWHERE {\n  ns:%s ?relation ?x .\n}"""
+sparql_distinct_tail_relations = """\nPREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?relation\nWHERE {\n  ?x ?relation ns:%s .\n}"""
+sparql_frontier_relations = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?entity ?relation ?dir\nWHERE {\n  VALUES ?entity { %s }\n  {\n    ?entity ?relation ?x .\n    BIND("head" AS ?dir)\n  }\n  UNION\n  {\n    ?x ?relation ?entity .\n    BIND("tail" AS ?dir)\n  }\n%s}"""
+# abandon_rels as a FILTER of sparql_frontier_relations
+sparql_abandon_rels_filter = """  FILTER(?relation NOT IN (ns:type.object.type, ns:type.object.name) && !STRSTARTS(STR(?relation), "http://rdf.freebase.com/ns/common.") && !STRSTARTS(STR(?relation), "http://rdf.freebase.com/ns/freebase.") && !CONTAINS(STR(?relation), "sameAs"))\n"""
 sparql_id = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?tailEntity\nWHERE {\n  {\n    ?entity ns:type.object.name ?tailEntity .\n    FILTER(?entity = ns:%s)\n  }\n  UNION\n  {\n    ?entity <http://www.w3.org/2002/07/owl#sameAs> ?tailEntity .\n    FILTER(?entity = ns:%s)\n  }\n}"""
+sparql_ids = """PREFIX ns: <http://rdf.freebase.com/ns/>\nSELECT DISTINCT ?entity ?tailEntity\nWHERE {\n  VALUES ?entity { %s }\n  {\n    ?entity ns:type.object.name ?tailEntity .\n  }\n  UNION\n  {\n    ?entity <http://www.w3.org/2002/07/owl#sameAs> ?tailEntity .\n  }\n}"""
     
 def check_end_word(s):
     words = [" ID", " code", " number", "instance of", "website", "URL", "inception", "image", " rate", " count"]
@@ -19,12 +42,40 @@ def abandon_rels(relation):
         return True
 
 
-def execurte_sparql(sparql_query):
-    sparql = SPARQLWrapper(SPARQLPATH)
-    sparql.setQuery(sparql_query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+def setup_sparql(args):
+    global sparql_client, sparql_cache, kg_store
+    if args.kg_store:
+        kg_store = KGStore(args.kg_store)
+    endpoints = args.sparql_endpoints.split(",") if args.sparql_endpoints else sparql_client.endpoints
+    sparql_client = SPARQLClient(endpoints, args.sparql_timeout, args.sparql_retries, args.sparql_balance, max(args.fanout_workers * args.num_workers, 16))
+    if args.sparql_cache:
+        sparql_cache = SPARQLCache(args.sparql_cache, args.sparql_cache_memory, args.sparql_cache_size, args.sparql_cache_ttl)
+        if args.sparql_cache_warm:
+            print("SPARQL cache: %d results loaded from %s." % (sparql_cache.warm(args.sparql_cache_warm), args.sparql_cache_warm))
+
+
+def report_sparql_usage():
+    if kg_store is not None:
+        print("KG store: %s" % kg_store.stats())
+    for usage in sparql_client.stats():
+        print("SPARQL endpoint %s: %d queries, %d failed." % (usage["endpoint"], usage["queries"], usage["failures"]))
+    if sparql_cache is not None:
+        stats = sparql_cache.stats()
+        print("SPARQL cache: %d memory hits, %d disk hits, %d misses (hit rate %.2f%%), %d entries." % (stats["memory_hits"], stats["disk_hits"], stats["misses"], stats["hit_rate"] * 100, stats["entries"]))
+        sparql_cache.close()
+
+
+def execurte_sparql(sparql_query, cache=True):
+    cache = cache and sparql_cache is not None
+    if cache:
+        bindings = sparql_cache.get(sparql_query)
+        if bindings is not None:
+            return bindings
+    bindings = sparql_client.query(sparql_query)
+    # a random sample is drawn anew on every query
+    if cache and "RAND()" not in sparql_query:
+        sparql_cache.put(sparql_query, bindings)
+    return bindings
 
 
 def replace_relation_prefix(relations):
@@ -34,16 +85,47 @@ def replace_entities_prefix(entities):
     return [entity['tailEntity']['value'].replace("http://rdf.freebase.com/ns/","") for entity in entities]
 
 
+# MID -> name of every entity resolved during the run, names never change within a run
+_entity_names = {}
+_entity_names_lock = threading.Lock()
+
+
 def id2entity_name_or_type(entity_id):
-    sparql_query = sparql_id % (entity_id, entity_id)
-    sparql = SPARQLWrapper(SPARQLPATH)
-    sparql.setQuery(sparql_query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    if len(results["results"]["bindings"])==0:
-        return "UnName_Entity"
-    else:
-        return results["results"]["bindings"][0]['tailEntity']['value']
+    return id2entity_names([entity_id])[0]
+
+
+def id2entity_names(entity_ids, batch_size=100):
+    """
+    Names of `entity_ids`, in order, "UnName_Entity" for entities without one.
+
+    MIDs not resolved earlier in the run are looked up `batch_size` at a time with a
+    single VALUES query, the same name / sameAs union as `sparql_id`.
+    """
+    if kg_store is not None:
+        return [name or "UnName_Entity" for name in kg_store.names(entity_ids)]
+    with _entity_names_lock:
+        missing = [entity_id for entity_id in dict.fromkeys(entity_ids) if entity_id not in _entity_names]
+    if sparql_cache is not None:
+        # names are cached one entity at a time, as results of `sparql_id`, since batches differ from run to run
+        cached = {}
+        for entity_id in missing:
+            bindings = sparql_cache.get(sparql_id % (entity_id, entity_id))
+            if bindings is not None:
+                cached[entity_id] = bindings[0]['tailEntity']['value'] if bindings else "UnName_Entity"
+        with _entity_names_lock:
+            _entity_names.update(cached)
+        missing = [entity_id for entity_id in missing if entity_id not in cached]
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        names = {}
+        for row in execurte_sparql(sparql_ids % " ".join("ns:" + entity_id for entity_id in batch), cache=False):
+            names.setdefault(row['entity']['value'].replace("http://rdf.freebase.com/ns/", ""), row['tailEntity']['value'])
+        if sparql_cache is not None:
+            sparql_cache.put_many((sparql_id % (entity_id, entity_id), [{'tailEntity': {'value': names[entity_id]}}] if entity_id in names else []) for entity_id in batch)
+        with _entity_names_lock:
+            _entity_names.update((entity_id, names.get(entity_id, "UnName_Entity")) for entity_id in batch)
+    with _entity_names_lock:
+        return [_entity_names[entity_id] for entity_id in entity_ids]
     
 from freebase_func import *
 from prompt_list import *
@@ -99,6 +181,7 @@ def clean_relations_bm25_sent(topn_relations, topn_scores, entity_id, head_relat
 
 
 def construct_relation_prune_prompt(question, entity_name, total_relations, args):
+    total_relations = fit_relations_to_budget(question, entity_name, total_relations, args.relation_token_budget)
     return extract_relation_prompt % (args.width, args.width) + question + '\nTopic Entity: ' + entity_name + '\nRelations: '+ '; '.join(total_relations) + "\nA: "
         
 
@@ -106,14 +189,24 @@ def construct_entity_score_prompt(question, relation, entity_candidates):
     return score_entity_candidates_prompt.format(question, relation) + "; ".join(entity_candidates) + '\nScore: '
 
 
-def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, question, args):
-    sparql_relations_extract_head = sparql_head_relations % (entity_id)
-    head_relations = execurte_sparql(sparql_relations_extract_head)
-    head_relations = replace_relation_prefix(head_relations)
-    
-    sparql_relations_extract_tail= sparql_tail_relations % (entity_id)
-    tail_relations = execurte_sparql(sparql_relations_extract_tail)
-    tail_relations = replace_relation_prefix(tail_relations)
+@track_stage("relation_search_prune")
+def relation_search(entity_id, pre_relations, pre_head, args, relations=None):
+    """
+    KG half of `relation_search_prune`: returns the head relations and all the candidate relations of the entity.
+
+    `relations` are its (head relations, tail relations) when they were already fetched by `frontier_relations`.
+    """
+    cached = relations or (kg_store.relations(entity_id) if kg_store is not None else kg_cache.get("relations", entity_id))
+    if cached is not None:
+        head_relations, tail_relations = cached
+    else:
+        sparql_relations_extract_head = sparql_head_relations % (entity_id)
+        head_relations = execurte_sparql(sparql_relations_extract_head)
+        head_relations = replace_relation_prefix(head_relations)
+        
+        sparql_relations_extract_tail= sparql_tail_relations % (entity_id)
+        tail_relations = execurte_sparql(sparql_relations_extract_tail)
+        tail_relations = replace_relation_prefix(tail_relations)
 
     if args.remove_unnecessary_rel:
         head_relations = [relation for relation in head_relations if not abandon_rels(relation)]
@@ -123,12 +216,19 @@ def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, quest
         tail_relations = list(set(tail_relations) - set(pre_relations))
     else:
         head_relations = list(set(head_relations) - set(pre_relations))
+    if args.compound_hops:
+        # an entity reached through a compound relation was reached forward through its last hop
+        tail_relations = [relation for relation in tail_relations if not any(pre_relation.endswith("." + relation) for pre_relation in pre_relations)]
 
     head_relations = list(set(head_relations))
     tail_relations = list(set(tail_relations))
     total_relations = head_relations+tail_relations
     total_relations.sort()  # make sure the order in prompt is always equal
-    
+    return head_relations, total_relations
+
+
+@track_stage("relation_search_prune")
+def relation_prune(entity_id, entity_name, head_relations, total_relations, question, args):
     if args.prune_tools == "llm":
         prompt = construct_relation_prune_prompt(question, entity_name, total_relations, args)
 
@@ -147,14 +247,108 @@ def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, quest
         return retrieve_relations_with_scores
     else:
         return [] # format error or too small max_length
-    
-    
+
+
+@track_stage("relation_search_prune")
+def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, question, args):
+    head_relations, total_relations = relation_search(entity_id, pre_relations, pre_head, args)
+    return relation_prune(entity_id, entity_name, head_relations, total_relations, question, args)
+
+
+def search_relations(entity_id, entity_name, pre_relations, pre_head, question, args, explored=None):
+    """`relation_search_prune`, reusing what a speculative exploration already fetched for the entity."""
+    if explored is None:
+        return relation_search_prune(entity_id, entity_name, pre_relations, pre_head, question, args)
+    head_relations, total_relations, retrieve_relations_with_scores = explored[entity_id]
+    if retrieve_relations_with_scores is None:
+        retrieve_relations_with_scores = relation_prune(entity_id, entity_name, head_relations, total_relations, question, args)
+    return retrieve_relations_with_scores
+
+
+@track_stage("relation_search_prune")
+def frontier_relations(entities_id, args):
+    """
+    (head relations, tail relations) of each entity, fetched for all of them with one query.
+
+    The query returns distinct (entity, relation, direction) rows and, with
+    `remove_unnecessary_rel`, drops the `abandon_rels` relations server side. Entities already
+    in the KG cache are not queried.
+    """
+    relations = {}
+    pending = []
+    for entity in dict.fromkeys(entities_id):
+        cached = kg_store.relations(entity) if kg_store is not None else kg_cache.get("relations", entity)
+        if cached is not None:
+            relations[entity] = cached
+        else:
+            relations[entity] = ([], [])
+            pending.append(entity)
+    if pending:
+        sparql_query = sparql_frontier_relations % (" ".join("ns:" + entity for entity in pending), sparql_abandon_rels_filter if args.remove_unnecessary_rel else "")
+        for row in execurte_sparql(sparql_query):
+            entity = row['entity']['value'].replace("http://rdf.freebase.com/ns/", "")
+            relations[entity][0 if _is_head_row(row) else 1].append(row['relation']['value'].replace("http://rdf.freebase.com/ns/", ""))
+    return relations
+
+
+def _is_head_row(row):
+    # the direction is a plain string, Virtuoso 7 may serialize an xsd:boolean as "1"/"0" rather than "true"/"false",
+    # rows of a boolean ?head binding are still read either way
+    if 'dir' in row:
+        return row['dir']['value'] == "head"
+    return row['head']['value'] in ("true", "1")
+
+
+def search_frontier_relations(entities_id, pre_relations, pre_heads, args):
+    """The KG half of the relation search of a whole frontier, in the form `search_relations` reads as `explored`."""
+    relations = frontier_relations([entity for entity in entities_id if entity != "[FINISH_ID]"], args)
+    explored = {}
+    for i, entity in enumerate(entities_id):
+        if entity == "[FINISH_ID]":
+            continue
+        head_relations, total_relations = relation_search(entity, pre_relations, pre_heads[i], args, relations[entity])
+        explored[entity] = (head_relations, total_relations, None)
+    return explored
+
+
+@track_stage("speculative_exploration")
+def explore_next_depth(entities_id, pre_relations, pre_heads, question, args, cancelled=None):
+    """
+    Start the next depth from the entities kept by `entity_prune`, before the reasoning verdict is known.
+
+    Returns the next topic entities and, for each of them, (head_relations, total_relations,
+    pruned relations). The pruned relations are only computed with the "prune" mode and are
+    None otherwise. Nothing here depends on the verdict, so the result is either used as is
+    by the next depth or thrown away when the question is answered. The exploration stops
+    early, returning None, once `cancelled` is set.
+    """
+    _, entities_id = if_finish_list(entities_id)
+    topic_entity = dict(zip(entities_id, id2entity_names(entities_id)))
+    relations = frontier_relations(entities_id, args) if args.relation_query == "combined" else {}
+    explored = {}
+    for i, entity in enumerate(topic_entity):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        head_relations, total_relations = relation_search(entity, pre_relations, pre_heads[i], args, relations.get(entity))
+        if cancelled is not None and cancelled.is_set():
+            return None
+        pruned = relation_prune(entity, topic_entity[entity], head_relations, total_relations, question, args) if args.speculative_exploration == "prune" else None
+        explored[entity] = (head_relations, total_relations, pruned)
+    return topic_entity, explored
+
+
+@track_stage("entity_search")
 def entity_search(entity, relation, head=True):
+    if kg_store is not None:
+        return _store_entities(entity, relation, head)
+    cached = kg_cache.get("entities", entity, relation, head)
+    if cached is not None:
+        return cached
     if head:
         tail_entities_extract = sparql_tail_entities_extract% (entity, relation)
         entities = execurte_sparql(tail_entities_extract)
     else:
-        head_entities_extract = sparql_head_entities_extract% (entity, relation)
+        head_entities_extract = sparql_head_entities_extract% (relation, entity)
         entities = execurte_sparql(head_entities_extract)
 
 
@@ -163,8 +357,168 @@ def entity_search(entity, relation, head=True):
     return new_entity
 
 
-def entity_score(question, entity_candidates_id, score, relation, args):
-    entity_candidates = [id2entity_name_or_type(entity_id) for entity_id in entity_candidates_id]
+@track_stage("entity_search")
+def entity_search_capped(entity, relation, head=True, cap=100, randomize=False):
+    """
+    `entity_search` bounded to `cap` entities, returns (entity ids, number of entities reached).
+
+    The count, the sample (random with `randomize`, otherwise in store order) and the names
+    of the sampled entities come from a single query, the names go to the name memo.
+    """
+    if kg_store is not None:
+        entity_ids = _store_entities(entity, relation, head)
+        sample = random.sample(entity_ids, cap) if randomize and len(entity_ids) > cap else entity_ids[:cap]
+        return sample, len(entity_ids)
+    cached = kg_cache.get("entities", entity, relation, head)
+    if cached is not None:
+        sample = random.sample(cached, min(cap, len(cached))) if randomize else cached[:cap]
+        return sample, len(cached)
+    order = "ORDER BY RAND()\n    " if randomize else ""
+    if head:
+        rows = execurte_sparql(sparql_tail_entities_capped % (entity, relation, entity, relation, order, cap))
+    else:
+        rows = execurte_sparql(sparql_head_entities_capped % (relation, entity, relation, entity, order, cap))
+    if len(rows) == 0:
+        return [], 0
+    names = {}
+    for row in rows:
+        entity_id = row['tailEntity']['value'].replace("http://rdf.freebase.com/ns/", "")
+        names.setdefault(entity_id, row['name']['value'] if 'name' in row else None)
+    with _entity_names_lock:
+        # entities without a name keep going through id2entity_names, which also looks at sameAs
+        _entity_names.update((entity_id, name) for entity_id, name in names.items() if name is not None)
+    return list(names), int(rows[0]['total']['value'])
+
+
+@track_stage("entity_search")
+def entity_search_compound(entity, relation, head=True, limit=1000):
+    """
+    `entity_search` that looks through nameless mediator (CVT) nodes in the same query.
+
+    Named entities reached through `relation` are returned as is. A nameless one is taken
+    for a CVT and replaced by the named entities it points to, reached through the compound
+    relation "relation.second_relation" from which the next depth goes on as if reached forward.
+    When `relation` is followed backward (the CVT points to `entity`), the compound relation
+    marks it inverse as in a SPARQL path, "^relation.second_relation".
+    Returns (entity ids, number of entities, {entity id: (compound relation, head)} of the
+    entities reached through a CVT). The names go to the name memo.
+    """
+    if kg_store is not None:
+        return _compound_from_store(entity, relation, head, limit)
+    if head:
+        sparql_query = sparql_tail_entities_compound % (entity, relation, entity, relation, entity, sparql_abandon_rels_filter, limit)
+    else:
+        sparql_query = sparql_head_entities_compound % (relation, entity, relation, entity, entity, sparql_abandon_rels_filter, limit)
+    names = {}
+    paths = {}
+    for row in execurte_sparql(sparql_query):
+        entity_id = row['tailEntity']['value'].replace("http://rdf.freebase.com/ns/", "")
+        if entity_id in names:
+            continue
+        names[entity_id] = row['name']['value']
+        if 'relation' in row:
+            paths[entity_id] = (_compound_relation(relation, head, row['relation']['value'].replace("http://rdf.freebase.com/ns/", "")), True)
+    with _entity_names_lock:
+        _entity_names.update(names)
+    return list(names), len(names), paths
+
+
+def _compound_relation(relation, head, second_relation):
+    return "%s%s.%s" % ("" if head else "^", relation, second_relation)
+
+
+def _store_entities(entity, relation, head):
+    # same filtering as entity_search
+    return [entity_id for entity_id in kg_store.neighbours(entity, relation, head) if entity_id.startswith("m.")]
+
+
+def _compound_from_store(entity, relation, head, limit):
+    names = {}
+    paths = {}
+    for neighbour in _store_entities(entity, relation, head):
+        if len(names) >= limit:
+            break
+        name = kg_store.name(neighbour)
+        if name is not None:
+            names.setdefault(neighbour, name)
+            continue
+        for second_relation, tail in kg_store.edges(neighbour):
+            if tail is None or tail == entity or tail in names or not tail.startswith("m.") or abandon_rels(second_relation):
+                continue
+            tail_name = kg_store.name(tail)
+            if tail_name is not None:
+                names[tail] = tail_name
+                paths[tail] = (_compound_relation(relation, head, second_relation), True)
+    return list(names)[:limit], min(len(names), limit), paths
+
+
+def _query_neighborhood(entities, template, max_triples):
+    """(entity, relation, neighbour) rows of a batch of entities, None when the result was cut by the limit."""
+    rows = execurte_sparql(template % (" ".join("ns:" + entity for entity in entities), max_triples))
+    if len(rows) >= max_triples:
+        return None
+    strip = lambda row, var: row[var]["value"].replace("http://rdf.freebase.com/ns/", "")
+    return [(strip(row, "entity"), strip(row, "relation"), strip(row, "x")) for row in rows]
+
+
+def _prefetch_batch(entities, max_triples):
+    out_rows = _query_neighborhood(entities, sparql_neighborhood_out, max_triples)
+    in_rows = _query_neighborhood(entities, sparql_neighborhood_in, max_triples) if out_rows is not None else None
+    if out_rows is None or in_rows is None:
+        if len(entities) > 1:
+            half = len(entities) // 2
+            _prefetch_batch(entities[:half], max_triples)
+            _prefetch_batch(entities[half:], max_triples)
+            return
+        # hub entity, only its relations are cached and its neighbours are searched lazily
+        entity = entities[0]
+        head_relations = replace_relation_prefix(execurte_sparql(sparql_distinct_head_relations % entity))
+        tail_relations = replace_relation_prefix(execurte_sparql(sparql_distinct_tail_relations % entity))
+        kg_cache.put_many([(("relations", entity), [head_relations, tail_relations])])
+        return
+
+    relations = {entity: (set(), set()) for entity in entities}
+    neighbours = {}
+    for rows, head in ((out_rows, True), (in_rows, False)):
+        for entity, relation, neighbour in rows:
+            relations[entity][0 if head else 1].add(relation)
+            neighbours.setdefault((entity, relation, head), []).append(neighbour)
+    items = [(("relations", entity), [sorted(head_relations), sorted(tail_relations)]) for entity, (head_relations, tail_relations) in relations.items()]
+    # same filtering as entity_search
+    items += [(("entities", entity, relation, head), [neighbour for neighbour in entity_ids if neighbour.startswith("m.")]) for (entity, relation, head), entity_ids in neighbours.items()]
+    kg_cache.put_many(items)
+
+
+def prefetch_neighborhoods(entity_ids, batch_size=50, max_triples=10000):
+    """
+    Pull the one-hop relations and neighbours of `entity_ids` into the KG cache with batched SPARQL.
+
+    Entities are queried `batch_size` at a time with VALUES. A batch whose result reaches
+    `max_triples` is split in halves, and an entity exceeding it alone only gets its relation
+    lists cached. Entities already in the cache are skipped.
+    """
+    if kg_store is not None:
+        print("KG prefetch skipped, the KG store is local.")
+        return
+    pending = [entity for entity in dict.fromkeys(entity_ids) if kg_cache.get("relations", entity) is None]
+    for start in tqdm(range(0, len(pending), batch_size), desc="KG prefetch"):
+        _prefetch_batch(pending[start:start + batch_size], max_triples)
+    print("KG prefetch: %d topic entities, %d fetched." % (len(set(entity_ids)), len(pending)))
+
+
+def construct_entity_score_batch_prompt(question, relations, entity_candidates_list):
+    groups = ['%d. Relation: %s\nEntites: %s' % (i, relation, "; ".join(entity_candidates)) for i, (relation, entity_candidates) in enumerate(zip(relations, entity_candidates_list), start=1)]
+    return score_entity_candidates_batch_prompt + question + '\n' + '\n'.join(groups) + '\nScore:\n'
+
+
+def resolve_entity_candidates(entity_candidates_id, score):
+    """
+    Resolve the candidate names and settle the cases that need no scoring.
+
+    Returns (scores, entity_candidates, entity_candidates_id), scores is None when the
+    candidates still have to be scored, in which case they are sorted by name.
+    """
+    entity_candidates = id2entity_names(entity_candidates_id)
     if all_unknown_entity(entity_candidates):
         return [1/len(entity_candidates) * score] * len(entity_candidates), entity_candidates, entity_candidates_id
     entity_candidates = del_unknown_entity(entity_candidates)
@@ -178,6 +532,18 @@ def entity_score(question, entity_candidates_id, score, relation, args):
     entity_candidates, entity_candidates_id = zip(*zipped_lists)
     entity_candidates = list(entity_candidates)
     entity_candidates_id = list(entity_candidates_id)
+    return None, entity_candidates, entity_candidates_id
+
+
+@track_stage("entity_score")
+def entity_score(question, entity_candidates_id, score, relation, args):
+    scores, entity_candidates, entity_candidates_id = resolve_entity_candidates(entity_candidates_id, score)
+    if scores is not None:
+        return scores, entity_candidates, entity_candidates_id
+    return score_entity_candidates(question, entity_candidates, entity_candidates_id, score, relation, args)
+
+
+def score_entity_candidates(question, entity_candidates, entity_candidates_id, score, relation, args):
     if args.prune_tools == "llm":
         prompt = construct_entity_score_prompt(question, relation, entity_candidates)
 
@@ -193,21 +559,44 @@ def entity_score(question, entity_candidates_id, score, relation, args):
         topn_scores = [float(1/len(topn_scores))] * len(topn_scores)
     return [float(x) * score for x in topn_scores], topn_entities, entity_candidates_id
 
+
+@track_stage("entity_score")
+def entity_score_batch(question, entity_candidates_id_list, score_list, relation_list, args):
+    """
+    Score the candidates of all relations of a depth with a single LLM call.
+
+    Returns one (scores, entity_candidates, entity_candidates_id) per relation, in input order.
+    Relations whose scores cannot be parsed from the batched output are scored one by one.
+    """
+    results = fan_out(resolve_entity_candidates, list(zip(entity_candidates_id_list, score_list)))
+    pending = [i for i, (scores, _, _) in enumerate(results) if scores is None]
+    if len(pending) == 1:
+        i = pending[0]
+        results[i] = score_entity_candidates(question, results[i][1], results[i][2], score_list[i], relation_list[i], args)
+    if len(pending) <= 1:
+        return results
+
+    entity_candidates_list = [results[i][1] for i in pending]
+    prompt = construct_entity_score_batch_prompt(question, [relation_list[i] for i in pending], entity_candidates_list)
+    # one line of scores per relation, the explanation after them may be cut off
+    max_tokens = max(args.max_length, 40 * len(pending))
+    result = run_llm(prompt, args.temperature_exploration, max_tokens, args.opeani_api_keys, args.LLM_type)
+    for i, scores in zip(pending, clean_scores_batch(result, entity_candidates_list)):
+        _, entity_candidates, entity_candidates_id = results[i]
+        if scores is None:
+            print("Batched entity scoring failed for relation %s, scoring it alone." % relation_list[i])
+            results[i] = score_entity_candidates(question, entity_candidates, entity_candidates_id, score_list[i], relation_list[i], args)
+        else:
+            results[i] = [float(x) * score_list[i] for x in scores], entity_candidates, entity_candidates_id
+    return results
+
     
-def update_history(entity_candidates, entity, scores, entity_candidates_id, total_candidates, total_scores, total_relations, total_entities_id, total_topic_entities, total_head):
+def update_history(frontier, entity, entity_candidates, scores, entity_candidates_id, paths=None):
     if len(entity_candidates) == 0:
         entity_candidates.append("[FINISH]")
         entity_candidates_id = ["[FINISH_ID]"]
-    candidates_relation = [entity['relation']] * len(entity_candidates)
-    topic_entities = [entity['entity']] * len(entity_candidates)
-    head_num = [entity['head']] * len(entity_candidates)
-    total_candidates.extend(entity_candidates)
-    total_scores.extend(scores)
-    total_relations.extend(candidates_relation)
-    total_entities_id.extend(entity_candidates_id)
-    total_topic_entities.extend(topic_entities)
-    total_head.extend(head_num)
-    return total_candidates, total_scores, total_relations, total_entities_id, total_topic_entities, total_head
+    frontier.add(entity, entity_candidates, entity_candidates_id, scores, paths)
+    return frontier
 
 
 def half_stop(question, cluster_chain_of_entities, depth, args):
@@ -216,6 +605,16 @@ def half_stop(question, cluster_chain_of_entities, depth, args):
     save_2_jsonl(question, answer, cluster_chain_of_entities, file_name=args.dataset)
 
 
+def budget_stop(question, cluster_chain_of_entities, budget, depth, args):
+    print("The %s budget of the question ran out at depth %d, answering with the knowledge found so far." % (budget, depth))
+    if cluster_chain_of_entities:
+        answer = generate_answer(question, cluster_chain_of_entities, args)
+    else:
+        answer = generate_without_explored_paths(question, args)
+    save_2_jsonl(question, answer, cluster_chain_of_entities, file_name=args.dataset, budget_stop=budget)
+
+
+@track_stage("generate_answer")
 def generate_answer(question, cluster_chain_of_entities, args): 
     prompt = answer_prompt + question + '\n'
     chain_prompt = '\n'.join([', '.join([str(x) for x in chain]) for sublist in cluster_chain_of_entities for chain in sublist])
@@ -224,29 +623,28 @@ def generate_answer(question, cluster_chain_of_entities, args):
     return result
 
 
-def entity_prune(total_entities_id, total_relations, total_candidates, total_topic_entities, total_head, total_scores, args):
-    zipped = list(zip(total_entities_id, total_relations, total_candidates, total_topic_entities, total_head, total_scores))
-    sorted_zipped = sorted(zipped, key=lambda x: x[5], reverse=True)
-    sorted_entities_id, sorted_relations, sorted_candidates, sorted_topic_entities, sorted_head, sorted_scores = [x[0] for x in sorted_zipped], [x[1] for x in sorted_zipped], [x[2] for x in sorted_zipped], [x[3] for x in sorted_zipped], [x[4] for x in sorted_zipped], [x[5] for x in sorted_zipped]
-
-    entities_id, relations, candidates, topics, heads, scores = sorted_entities_id[:args.width], sorted_relations[:args.width], sorted_candidates[:args.width], sorted_topic_entities[:args.width], sorted_head[:args.width], sorted_scores[:args.width]
-    merged_list = list(zip(entities_id, relations, candidates, topics, heads, scores))
-    filtered_list = [(id, rel, ent, top, hea, score) for id, rel, ent, top, hea, score in merged_list if score != 0]
-    if len(filtered_list) ==0:
+def entity_prune(frontier, args):
+    kept = [candidate for candidate in frontier.top(args.width) if candidate.score != 0]
+    if len(kept) ==0:
         return False, [], [], [], []
-    entities_id, relations, candidates, tops, heads, scores = map(list, zip(*filtered_list))
 
-    tops = [id2entity_name_or_type(entity_id) for entity_id in tops]
-    cluster_chain_of_entities = [[(tops[i], relations[i], candidates[i]) for i in range(len(candidates))]]
-    return True, cluster_chain_of_entities, entities_id, relations, heads
+    topics = list(dict.fromkeys(candidate.topic_entity for candidate in kept))
+    names = dict(zip(topics, id2entity_names(topics)))
+    cluster_chain_of_entities = [[(names[candidate.topic_entity], candidate.relation, candidate.name) for candidate in kept]]
+    return True, cluster_chain_of_entities, [candidate.entity_id for candidate in kept], [candidate.relation for candidate in kept], [candidate.head for candidate in kept]
 
 
+@track_stage("reasoning")
 def reasoning(question, cluster_chain_of_entities, args):
     prompt = prompt_evaluate + question
     chain_prompt = '\n'.join([', '.join([str(x) for x in chain]) for sublist in cluster_chain_of_entities for chain in sublist])
     prompt += "\nKnowledge Triplets: " + chain_prompt + 'A: '
 
-    response = run_llm(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type)
+    if args.stream_reasoning:
+        # a No verdict only needs its first tokens, the explanation after it is thrown away
+        response = run_llm_streaming(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type, negative_verdict)
+    else:
+        response = run_llm(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type)
     
     result = extract_answer(response)
     if if_true(result):
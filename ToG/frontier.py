@@ -0,0 +1,47 @@
+import heapq
+from operator import attrgetter
+
+
+class Candidate:
+    """An entity reached at the current depth, with the relation and topic entity it was reached from."""
+
+    __slots__ = ("entity_id", "name", "relation", "topic_entity", "head", "score")
+
+    def __init__(self, entity_id, name, relation, topic_entity, head, score):
+        self.entity_id = entity_id
+        self.name = name
+        self.relation = relation
+        self.topic_entity = topic_entity
+        self.head = head
+        self.score = score
+
+
+class Frontier:
+    """
+    Scored candidates of one search depth.
+
+    Replaces the six parallel lists (candidates, scores, relations, ids, topic entities,
+    heads) a depth used to build, and selects the best candidates with a bounded heap
+    instead of sorting all of them.
+    """
+
+    def __init__(self):
+        self.candidates = []
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def add(self, relation, entity_candidates, entity_candidates_id, scores, paths=None):
+        """
+        Add the candidates reached through `relation`, a relation dict as returned by the relation pruning.
+
+        `paths` maps the ids of candidates reached through a longer path to its (relation, head).
+        """
+        paths = paths or {}
+        for name, entity_id, score in zip(entity_candidates, entity_candidates_id, scores):
+            path_relation, head = paths.get(entity_id, (relation["relation"], relation["head"]))
+            self.candidates.append(Candidate(entity_id, name, path_relation, relation["entity"], head, score))
+
+    def top(self, width):
+        """The `width` best candidates, best first. Ties keep their insertion order, like a stable sort."""
+        return heapq.nlargest(width, self.candidates, key=attrgetter("score"))
@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import threading
+
+
+def _encode(value):
+    if isinstance(value, set):
+        return {"__set__": sorted(value)}
+    raise TypeError("cannot cache a %s" % type(value).__name__)
+
+
+def _decode(obj):
+    if "__set__" in obj and len(obj) == 1:
+        return set(obj["__set__"])
+    return obj
+
+
+class KGCache:
+    """
+    Local store of KG lookups, keyed by the lookup kind and its arguments.
+
+    It is filled in bulk before a run by the `prefetch_neighborhoods` of `freebase_func.py` /
+    `wiki_func.py`, and the search functions read it before querying the KG. Values are kept
+    as JSON in SQLite (sets included), so a prefetched dataset can be replayed with the KG
+    service switched off. Until `open` is called every lookup misses.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS lookups (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(kind, *args):
+        return json.dumps([kind] + list(args))
+
+    def get(self, kind, *args):
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM lookups WHERE key=?", (self.key(kind, *args),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0], object_hook=_decode)
+
+    def put_many(self, items):
+        """Store ((kind, *args), value) pairs."""
+        if self._conn is None:
+            return
+        rows = [(self.key(*key), json.dumps(value, default=_encode)) for key, value in items]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO lookups VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+
+
+kg_cache = KGCache()
@@ -0,0 +1,277 @@
+import array
+import bisect
+import gzip
+import json
+import mmap
+import os
+import sys
+
+FREEBASE_NS = "http://rdf.freebase.com/ns/"
+LITERAL = -1  # target of the edges to values (literals, non Freebase URIs), kept so that their relations are listed
+NAME_RELATIONS = ("type.object.name", "http://www.w3.org/2002/07/owl#sameAs")  # in order of preference, as in `sparql_id`
+FORMAT = 2
+OFFSET_TYPE = "q"
+ID_TYPE = "i"
+WRITE_BUFFER = 1 << 20
+
+
+def parse_ntriple(line):
+    """(subject, relation, object, object is a URI) of a dump line, ids without the Freebase namespace, None for other lines."""
+    parts = line.rstrip("\n").split("\t")
+    if len(parts) < 3:
+        parts = line.rstrip().rstrip(".").rstrip().split(" ", 2)
+        if len(parts) < 3:
+            return None
+    subject, relation, obj = parts[0], parts[1], parts[2].strip()
+    if not subject.startswith("<") or not relation.startswith("<"):
+        return None
+    subject = subject[1:-1].replace(FREEBASE_NS, "")
+    relation = relation[1:-1].replace(FREEBASE_NS, "")
+    if obj.startswith("<"):
+        return subject, relation, obj[1:-1].replace(FREEBASE_NS, ""), True
+    if obj.startswith('"'):
+        literal = obj[1:obj.rfind('"')]
+        try:
+            literal = json.loads('"%s"' % literal)
+        except ValueError:
+            pass
+        return subject, relation, literal, False
+    return subject, relation, obj, False
+
+
+def open_dump(path):
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")
+
+
+class ArrayWriter:
+    """Appends integers of one typecode to a binary file, `WRITE_BUFFER` at a time."""
+
+    def __init__(self, path, typecode):
+        self.file = open(path, "wb")
+        self.typecode = typecode
+        self.buffer = array.array(typecode)
+        self.count = 0
+
+    def append(self, value):
+        self.buffer.append(value)
+        self.count += 1
+        if len(self.buffer) >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        self.buffer.tofile(self.file)
+        self.buffer = array.array(self.typecode)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def write_strings(path, name, strings):
+    """Write strings, without newlines, one per line to `name`.txt and their byte offsets to `name`.index, returns their number."""
+    index = ArrayWriter(os.path.join(path, name + ".index"), OFFSET_TYPE)
+    offset = 0
+    with open(os.path.join(path, name + ".txt"), "wb") as f:
+        for string in strings:
+            index.append(offset)
+            line = (string + "\n").encode("utf-8")
+            f.write(line)
+            offset += len(line)
+    index.append(offset)
+    index.close()
+    return index.count - 1
+
+
+def write_csr(path, direction, n_nodes, edges):
+    """Write (node id, relation id, neighbour id) edges, sorted and distinct, as the CSR arrays of one direction, returns their number."""
+    offsets = ArrayWriter(os.path.join(path, direction + ".offsets"), OFFSET_TYPE)
+    relations = ArrayWriter(os.path.join(path, direction + ".relations"), ID_TYPE)
+    targets = ArrayWriter(os.path.join(path, direction + ".targets"), ID_TYPE)
+    for node, relation, neighbour in edges:
+        # the nodes up to this one start here, those before it have no edges left
+        while offsets.count <= node:
+            offsets.append(relations.count)
+        relations.append(relation)
+        targets.append(neighbour)
+    while offsets.count <= n_nodes:
+        offsets.append(relations.count)
+    for writer in (offsets, relations, targets):
+        writer.close()
+    return relations.count
+
+
+def write_meta(path, n_nodes, n_relations, n_edges, source):
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"format": FORMAT, "byteorder": sys.byteorder, "nodes": n_nodes, "relations": n_relations, "edges": n_edges, "source": source}, f)
+
+
+def write_store(path, triples, names, source=""):
+    """
+    Write a store from (subject, relation, object) triples, the object being None for a value, and a {node: name} dict.
+
+    Nodes and relations are the Freebase ids without the namespace, as returned by the SPARQL queries
+    of `freebase_func.py`. Nodes are numbered in sorted order, so a node id is found by bisection.
+    Everything is sorted in memory, `build_kg_index.py` writes the same files from a whole dump.
+    """
+    os.makedirs(path, exist_ok=True)
+    triples = set(triples)
+    nodes = sorted({subject for subject, _, _ in triples} | {obj for _, _, obj in triples if obj is not None} | set(names))
+    relations = sorted({relation for _, relation, _ in triples})
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    relation_ids = {relation: i for i, relation in enumerate(relations)}
+    out_edges = sorted((node_ids[subject], relation_ids[relation], LITERAL if obj is None else node_ids[obj]) for subject, relation, obj in triples)
+    in_edges = sorted((node_ids[obj], relation_ids[relation], node_ids[subject]) for subject, relation, obj in triples if obj is not None)
+    write_strings(path, "nodes", nodes)
+    write_strings(path, "relations", relations)
+    write_strings(path, "names", (json.dumps(names.get(node)) for node in nodes))
+    write_csr(path, "out", len(nodes), out_edges)
+    write_csr(path, "in", len(nodes), in_edges)
+    write_meta(path, len(nodes), len(relations), len(out_edges), source)
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""  # empty files cannot be mapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _map_array(path, typecode, swap=False):
+    if swap:
+        values = array.array(typecode)
+        values.frombytes(_map(path))
+        values.byteswap()
+        return values
+    return memoryview(_map(path)).cast(typecode)
+
+
+class _Lines:
+    """Encoded lines of a `write_strings` file."""
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.index[i]:self.index[i + 1] - 1]
+
+
+class StringTable:
+    """
+    Read-only sequence over the lines written by `write_strings`, decoded on access.
+
+    `find` bisects the encoded lines of a sorted table, UTF-8 keeps the order of str.
+    """
+
+    def __init__(self, path, name, swap=False):
+        self.lines = _Lines(_map(os.path.join(path, name + ".txt")), _map_array(os.path.join(path, name + ".index"), OFFSET_TYPE, swap))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i].decode("utf-8")
+
+    def find(self, string):
+        """Position of `string` in a sorted table, None if it is missing."""
+        key = string.encode("utf-8")
+        i = bisect.bisect_left(self.lines, key)
+        return i if i < len(self.lines) and self.lines[i] == key else None
+
+
+class KGStore:
+    """
+    Read-only Freebase graph answering the lookups of `freebase_func.py` without a SPARQL server.
+
+    Nodes and relations are integer ids, the edges of each direction are kept in CSR form
+    (per-node offsets into relation and neighbour arrays sorted by node, relation, neighbour),
+    so the relations of a node and its neighbours through a relation are found by bisection.
+    All files are memory-mapped read-only: opening a store does not read it, and the worker
+    processes of a machine share its pages through the OS page cache. Only a store written on a
+    machine of the other byte order is read and byte-swapped. Lookups of nodes outside the store
+    find nothing and are counted as misses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != FORMAT:
+            raise ValueError("KG store %s has format %s, not %d, rebuild it with extract_subgraph.py or build_kg_index.py." % (path, self.meta.get("format"), FORMAT))
+        swap = self.meta["byteorder"] != sys.byteorder
+        self.nodes = StringTable(path, "nodes", swap)
+        self.relation_names = list(StringTable(path, "relations", swap))
+        self.node_names = StringTable(path, "names", swap)
+        self.csr = {direction: tuple(_map_array(os.path.join(path, direction + suffix), typecode, swap)
+                                     for suffix, typecode in ((".offsets", OFFSET_TYPE), (".relations", ID_TYPE), (".targets", ID_TYPE)))
+                    for direction in ("out", "in")}
+        self.hits = 0
+        self.misses = 0
+
+    def node_id(self, node):
+        i = self.nodes.find(node)
+        if i is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return i
+
+    def _range(self, node, head):
+        offsets, relations, targets = self.csr["out" if head else "in"]
+        i = self.node_id(node)
+        if i is None:
+            return relations, targets, 0, 0
+        return relations, targets, offsets[i], offsets[i + 1]
+
+    def _relation_range(self, node, relation, head):
+        r = bisect.bisect_left(self.relation_names, relation)
+        relations, targets, lo, hi = self._range(node, head) if r < len(self.relation_names) and self.relation_names[r] == relation else (None, None, 0, 0)
+        if lo == hi:
+            return targets, 0, 0
+        return targets, bisect.bisect_left(relations, r, lo, hi), bisect.bisect_right(relations, r, lo, hi)
+
+    def _relations(self, node, head):
+        relations, _, lo, hi = self._range(node, head)
+        found = []
+        while lo < hi:
+            found.append(self.relation_names[relations[lo]])
+            lo = bisect.bisect_right(relations, relations[lo], lo, hi)
+        return found
+
+    def relations(self, node):
+        """(head relations, tail relations) of a node, as `sparql_head_relations` / `sparql_tail_relations` without duplicates."""
+        return self._relations(node, True), self._relations(node, False)
+
+    def edges(self, node, head=True):
+        """(relation, neighbour) pairs of a node, the neighbour is None for a value, as `sparql_neighborhood_out` / `sparql_neighborhood_in`."""
+        relations, targets, lo, hi = self._range(node, head)
+        return [(self.relation_names[relations[i]], None if targets[i] == LITERAL else self.nodes[targets[i]]) for i in range(lo, hi)]
+
+    def neighbours(self, node, relation, head=True, limit=None):
+        """
+        Nodes reached from `node` through `relation`, forward if `head`, values left out, as
+        `sparql_tail_entities_extract` / `sparql_head_entities_extract`. At most `limit` of them.
+        """
+        targets, lo, hi = self._relation_range(node, relation, head)
+        found = []
+        for i in range(lo, hi):
+            if targets[i] != LITERAL:
+                found.append(self.nodes[targets[i]])
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def name(self, node):
+        """Name of a node, type.object.name or else sameAs as in `sparql_id`, None if it has none."""
+        i = self.node_id(node)
+        return None if i is None else json.loads(self.node_names[i])
+
+    def names(self, nodes):
+        """`name` of each node, as `sparql_ids`."""
+        return [self.name(node) for node in nodes]
+
+    def stats(self):
+        return {"nodes": len(self.nodes), "edges": self.meta["edges"], "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,330 @@
+import asyncio
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import threading
+import re
+import zlib
+import aiohttp
+
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+LOCAL_API_BASE = "http://localhost:8000/v1"  # your local llama server port
+
+
+class LLMHTTPError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__("HTTP %d: %s" % (status, message))
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenAIBackend:
+    """
+    OpenAI-compatible chat completion endpoint reached through one pooled keep-alive session.
+
+    The aiohttp session is created on first use, inside the event loop of the LLM client,
+    and reused by every request of the run.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_base=OPENAI_API_BASE, pool_size=8):
+        self.api_base = api_base.rstrip("/")
+        self.pool_size = pool_size
+        self.models = {}
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def resolve_model(self, engine, api_key=None):
+        """Name of the served model to request for `engine`, looked up once and then cached."""
+        self.models[engine] = engine
+        return engine
+
+    def headers(self, api_key):
+        return {"Authorization": "Bearer %s" % api_key}
+
+    async def complete(self, messages, engine, temperature, max_tokens, api_key, timeout):
+        """Returns (content, usage) where usage holds prompt_tokens, completion_tokens and total_tokens."""
+        model = self.models.get(engine) or await self.resolve_model(engine, api_key)
+        payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "frequency_penalty": 0, "presence_penalty": 0}
+        async with self.session().post(self.api_base + "/chat/completions", json=payload, headers=self.headers(api_key), timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status != 200:
+                raise LLMHTTPError(response.status, await response.text(), _parse_retry_after(response.headers.get("retry-after")))
+            body = await response.json()
+        return body["choices"][0]["message"]["content"], body.get("usage", {})
+
+    async def stream(self, messages, engine, temperature, max_tokens, api_key, timeout, usage=None):
+        """
+        Yields the completion text chunk by chunk. Closing the generator early drops the connection, which stops the generation.
+
+        The usage the server sends at the end of a complete stream is copied into the `usage` dict.
+        """
+        model = self.models.get(engine) or await self.resolve_model(engine, api_key)
+        payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "frequency_penalty": 0, "presence_penalty": 0, "stream": True,
+                   "stream_options": {"include_usage": True}}
+        async with self.session().post(self.api_base + "/chat/completions", json=payload, headers=self.headers(api_key), timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status != 200:
+                raise LLMHTTPError(response.status, await response.text(), _parse_retry_after(response.headers.get("retry-after")))
+            finished = False
+            try:
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if chunk.get("usage") and usage is not None:
+                        usage.update(chunk["usage"])
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        yield delta
+                finished = True
+            finally:
+                if not finished:
+                    response.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class LocalBackend(OpenAIBackend):
+    """OpenAI-compatible local server (e.g. vLLM / FastChat serving llama), its model id is discovered once."""
+
+    name = "local"
+
+    def __init__(self, api_base=LOCAL_API_BASE, pool_size=8):
+        super().__init__(api_base, pool_size)
+
+    def headers(self, api_key):
+        return {"Authorization": "Bearer EMPTY"}
+
+    async def resolve_model(self, engine, api_key=None):
+        if engine not in self.models:
+            async with self.session().get(self.api_base + "/models", headers=self.headers(api_key)) as response:
+                if response.status != 200:
+                    raise LLMHTTPError(response.status, await response.text())
+                body = await response.json()
+            self.models[engine] = body["data"][0]["id"]
+        return self.models[engine]
+
+
+def _tokens(text):
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def _overlap_scores(question, items):
+    """Scores summing to 1, proportional to the words an item shares with the question (uniform if none do)."""
+    question_tokens = _tokens(question)
+    overlaps = [len(question_tokens & _tokens(item.replace(".", " ").replace("_", " "))) for item in items]
+    if sum(overlaps) == 0:
+        return [1 / len(items)] * len(items)
+    return [overlap / sum(overlaps) for overlap in overlaps]
+
+
+def heuristic_response(prompt):
+    """
+    Cheap deterministic stand-in for an LLM answer to the ToG / CoT prompts.
+
+    Relations and entities are scored by word overlap with the question, the sufficiency
+    check says Yes or No depending on the prompt hash, and answers name the last tail entity.
+    The outputs follow the formats the parsers in `utils.py` expect.
+    """
+    query = prompt[prompt.rfind("\nQ: ") + 4:] if "\nQ: " in prompt else prompt
+    question = query.split("\n")[0]
+    if "Topic Entity: " in query and "Relations:" in query:
+        match = re.match(r"Please retrieve (\d+) relations", prompt)
+        width = int(match.group(1)) if match else 3
+        relations_text = query[query.find("Relations:") + len("Relations:"):]
+        relations_text = relations_text[:relations_text.rfind("A:")]
+        relations = [re.sub(r"^\d+\.\s*", "", relation.strip()) for relation in re.split(r";|\n", relations_text)]
+        relations = [relation for relation in relations if relation]
+        if not relations:
+            return "No relations found."
+        ranked = sorted(zip(_overlap_scores(question, relations), relations), key=lambda x: (-x[0], x[1]))[:width]
+        total = sum(score for score, _ in ranked) or 1
+        return "\n".join("%d. {%s (Score: %.2f)}: relevant to the question." % (i, relation, score / total) for i, (score, relation) in enumerate(ranked, start=1))
+    if "\nScore:\n" in query:
+        groups = re.findall(r"^\d+\. Relation: .*\nEntites: (.*)$", query, re.M)
+        return "\n".join("%d. %s" % (i, ", ".join("%.2f" % score for score in _overlap_scores(question, entities.split("; ")))) for i, entities in enumerate(groups, start=1))
+    if "Entites: " in query:
+        entities = query[query.find("Entites: ") + len("Entites: "):].split("\nScore:")[0].split("; ")
+        return ", ".join("%.2f" % score for score in _overlap_scores(question, entities))
+    triplets = query[query.find("Knowledge Triplets: ") + len("Knowledge Triplets: "):query.rfind("A:")] if "Knowledge Triplets: " in query else ""
+    tail = triplets.strip().split("\n")[-1].split(", ")[-1].strip() if triplets.strip() else "Unknown"
+    if "(Yes or No)" in prompt:
+        if int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16) % 2:
+            return "{No}. The given knowledge triplets are not sufficient to answer the question."
+        return "{Yes}. Based on the given knowledge triplets, the answer to the question is {%s}." % tail
+    return "Based on the given knowledge, the answer is {%s}." % tail
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class MockBackend:
+    """
+    Offline deterministic backend answering with `heuristic_response`, for network-free runs.
+
+    Each answer takes `latency` seconds plus `latency_per_token` seconds per completion token,
+    to mimic the timing of a real server in throughput tests.
+    """
+
+    name = "mock"
+
+    def __init__(self, latency=0.0, latency_per_token=0.0):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.models = {}
+
+    async def resolve_model(self, engine, api_key=None):
+        self.models[engine] = engine
+        return engine
+
+    def respond(self, prompt, engine, temperature):
+        return heuristic_response(prompt)
+
+    def delay(self, content):
+        return self.latency + self.latency_per_token * (len(content) // 4)
+
+    async def complete(self, messages, engine, temperature, max_tokens, api_key, timeout):
+        prompt = messages[-1]["content"]
+        content = self.respond(prompt, engine, temperature)
+        if self.delay(content):
+            await asyncio.sleep(self.delay(content))
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return content, usage
+
+    async def stream(self, messages, engine, temperature, max_tokens, api_key, timeout, usage=None):
+        prompt = messages[-1]["content"]
+        content = self.respond(prompt, engine, temperature)
+        chunks = [content[i:i + 4] for i in range(0, len(content), 4)]
+        for chunk in chunks:
+            if self.delay(content):
+                await asyncio.sleep(self.delay(content) / len(chunks))
+            yield chunk
+        if usage is not None:
+            usage.update({"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4, "total_tokens": len(prompt) // 4 + len(content) // 4})
+
+    async def close(self):
+        pass
+
+
+class LLMRecorder:
+    """
+    Appends the prompt hash and completion of every LLM call of a run to a gzip JSON lines file.
+
+    Several recordings can go to the same file, `ReplayBackend` reads them all. The file is
+    closed at exit as well, so that a run ending on an exception still writes the gzip trailer.
+    """
+
+    def __init__(self, path, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        atexit.register(self.close)
+
+    def record(self, prompt, completion, engine, temperature):
+        line = json.dumps({"hash": prompt_hash(prompt), "engine": engine, "temperature": temperature, "completion": completion})
+        with self._lock:
+            self._file.write(line + "\n")
+            self.recorded += 1
+            if self.recorded % self.flush_every == 0:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class ReplayBackend(MockBackend):
+    """
+    Serves the completions of an `LLMRecorder` file by prompt hash, engine and temperature, with synthetic latency.
+
+    A prompt recorded several times (sampled calls) gets its completions back in recorded
+    order, cycling when exhausted. Prompts that were never recorded with the same engine and
+    temperature are answered by `heuristic_response`, so a replay never needs the network;
+    those recorded with other settings only are counted as mismatches.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, latency=0.0, latency_per_token=0.0):
+        super().__init__(latency, latency_per_token)
+        self.recordings = {}
+        self.served = {}
+        self.recorded_hashes = set()
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        if not os.path.exists(path):
+            raise FileNotFoundError("LLM recording %s not found, record one with --llm_record first." % path)
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if not line.endswith("\n"):
+                        raise EOFError("truncated line")
+                    if line.strip():
+                        item = json.loads(line)
+                        self.recordings.setdefault(self._key(item["hash"], item["engine"], item["temperature"]), []).append(item["completion"])
+                        self.recorded_hashes.add(item["hash"])
+            except (EOFError, zlib.error, gzip.BadGzipFile):
+                # a killed recording run leaves its gzip member without a trailer, what was flushed before is kept
+                print("LLM recording %s is truncated, the completions before the cut are replayed." % path)
+
+    @staticmethod
+    def _key(digest, engine, temperature):
+        return digest, engine, float(temperature)
+
+    def respond(self, prompt, engine, temperature):
+        key = self._key(prompt_hash(prompt), engine, temperature)
+        completions = self.recordings.get(key)
+        if not completions:
+            self.misses += 1
+            self.mismatches += int(key[0] in self.recorded_hashes)
+            return heuristic_response(prompt)
+        self.hits += 1
+        index = self.served.get(key, 0)
+        self.served[key] = index + 1
+        return completions[index % len(completions)]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "mismatches": self.mismatches, "recorded_prompts": len(self.recorded_hashes)}
+
+
+def get_backend(name, engine, api_base="", pool_size=8, replay_file="", latency=0.0, latency_per_token=0.0):
+    """`auto` keeps the historical behaviour: llama models go to the local server, others to OpenAI."""
+    if name == "auto":
+        name = "local" if "llama" in engine.lower() else "openai"
+    if name == "openai":
+        return OpenAIBackend(api_base or OPENAI_API_BASE, pool_size)
+    if name == "local":
+        return LocalBackend(api_base or LOCAL_API_BASE, pool_size)
+    if name == "mock":
+        return MockBackend(latency, latency_per_token)
+    if name == "replay":
+        return ReplayBackend(replay_file, latency, latency_per_token)
+    raise ValueError("unknown LLM backend %s, you should pick from {auto, openai, local, mock, replay}." % name)
@@ -0,0 +1,98 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class CompletionCache:
+    """
+    On-disk prompt -> completion cache backed by SQLite.
+
+    Entries are keyed by (engine, temperature, max_tokens, sha256(prompt)). When the
+    number of entries exceeds `max_entries`, the least recently used ones are evicted. Hits
+    do not write: their access times are kept in memory and written with the next insert,
+    every `ACCESS_BATCH` hits, and on `close`.
+
+    policy:
+    - "deterministic": only cache calls with temperature 0, sampled calls always hit the LLM.
+    - "all": cache every call, so reruns replay the first sampled completion.
+    """
+
+    POLICIES = ("deterministic", "all")
+    ACCESS_BATCH = 1000
+
+    def __init__(self, path, max_entries=100000, policy="deterministic"):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown cache policy %s, you should pick from %s." % (policy, self.POLICIES))
+        self.path = path
+        self.max_entries = max_entries
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._accessed = {}  # key -> last access not yet written
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS completions (
+            engine TEXT, temperature REAL, max_tokens INTEGER, prompt_hash TEXT,
+            completion TEXT, last_access REAL,
+            PRIMARY KEY (engine, temperature, max_tokens, prompt_hash))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def prompt_hash(prompt):
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def cacheable(self, temperature):
+        return self.policy == "all" or temperature == 0
+
+    def get(self, prompt, temperature, max_tokens, engine):
+        if not self.cacheable(temperature):
+            return None
+        key = (engine, float(temperature), max_tokens, self.prompt_hash(prompt))
+        with self._lock:
+            row = self._conn.execute("SELECT completion FROM completions WHERE engine=? AND temperature=? AND max_tokens=? AND prompt_hash=?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= self.ACCESS_BATCH:
+                self._write_accesses()
+                self._conn.commit()
+            return row[0]
+
+    def _write_accesses(self):
+        self._conn.executemany("UPDATE completions SET last_access=? WHERE engine=? AND temperature=? AND max_tokens=? AND prompt_hash=?",
+                               [(accessed,) + key for key, accessed in self._accessed.items()])
+        self._accessed = {}
+
+    def put(self, prompt, temperature, max_tokens, engine, completion):
+        if not self.cacheable(temperature):
+            return
+        key = (engine, float(temperature), max_tokens, self.prompt_hash(prompt))
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO completions VALUES (?, ?, ?, ?, ?, ?)", key + (completion, time.time()))
+            self._size += cursor.rowcount
+            self._write_accesses()
+            if self._size > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # drop a tenth of the cache at once so that eviction does not run on every insert
+        n_evict = self._size - self.max_entries + max(1, self.max_entries // 10)
+        self._conn.execute("DELETE FROM completions WHERE rowid IN (SELECT rowid FROM completions ORDER BY last_access LIMIT ?)", (n_evict,))
+        self._size = self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "entries": self._size}
+
+    def close(self):
+        with self._lock:
+            self._write_accesses()
+            self._conn.commit()
+            self._conn.close()
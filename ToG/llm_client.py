@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+import aiohttp
+from rate_limit import RateLimitScheduler
+from llm_backends import LLMHTTPError, get_backend
+
+
+SYSTEM_PROMPT = "You are an AI assistant that helps people find information."
+
+
+class AsyncLLMClient:
+    """
+    Asynchronous chat completion client shared by every LLM call of a run.
+
+    All requests go through one event loop running in a daemon thread, so a single
+    semaphore bounds the number of in-flight requests no matter how many threads
+    or coroutines issue them. Synchronous callers use `run_sync`, asynchronous
+    callers can await `run_llm` / `run_llm_many` directly on `self.loop`.
+    An optional `CompletionCache` is consulted before any request is sent, and a
+    `RateLimitScheduler` paces the requests and decides how failed ones are retried.
+    Requests are sent by a backend from `llm_backends.py`; without a configured one,
+    the backend is picked from the engine name. With a recorder, every completion handed
+    back to a caller is also logged for later replay.
+    """
+
+    def __init__(self, concurrency=8, timeout=60, cache=None, scheduler=None, backend=None, recorder=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache = cache
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.backend = backend
+        self.recorder = recorder
+        self._auto_backends = {}
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def configure(self, concurrency=None, timeout=None, cache=None, scheduler=None, backend=None, recorder=None):
+        if concurrency is not None:
+            self.concurrency = concurrency
+            self._semaphore = None  # rebuilt with the new bound on next call
+        if timeout is not None:
+            self.timeout = timeout
+        if cache is not None:
+            self.cache = cache
+        if scheduler is not None:
+            self.scheduler = scheduler
+        if backend is not None:
+            self.backend = backend
+        if recorder is not None:
+            self.recorder = recorder
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True).start()
+        return self._loop
+
+    def run_sync(self, coro):
+        """Run a coroutine on the client loop and block the calling thread until it is done."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def get_backend(self, engine):
+        if self.backend is not None:
+            return self.backend
+        if engine not in self._auto_backends:
+            self._auto_backends[engine] = get_backend("auto", engine, pool_size=self.concurrency)
+        return self._auto_backends[engine]
+
+    async def close(self):
+        """Close the connection pools of the backends, run it on the client loop before exiting."""
+        for backend in [self.backend] + list(self._auto_backends.values()):
+            if backend is not None:
+                await backend.close()
+
+    async def _create(self, messages, temperature, max_tokens, api_key, engine):
+        content, usage = await self.get_backend(engine).complete(messages, engine, temperature, max_tokens, api_key, self.timeout)
+        return (content, usage), usage.get("total_tokens")
+
+    @staticmethod
+    def classify_error(e):
+        """Returns (retryable, throttled, retry_after) for an exception raised by a request."""
+        if isinstance(e, (asyncio.TimeoutError, aiohttp.ClientError)):
+            return True, False, None
+        if isinstance(e, LLMHTTPError):
+            if e.status == 429:
+                return True, True, e.retry_after
+            if e.status >= 500 or e.status == 408:
+                return True, False, e.retry_after
+        # the other HTTP statuses, a malformed answer or a bug, retrying would only repeat them
+        return False, False, None
+
+    async def run_llm(self, prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
+        result, _ = await self.run_llm_with_usage(prompt, temperature, max_tokens, opeani_api_keys, engine)
+        return result
+
+    async def run_llm_with_usage(self, prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
+        """Returns (completion, usage), usage holds the token counts, the latency in seconds and whether the cache answered."""
+        start = time.perf_counter()
+        if self.cache is not None:
+            result = await self._off_loop(self.cache.get, prompt, temperature, max_tokens, engine)
+            if result is not None:
+                self._record(prompt, result, engine, temperature)
+                return result, {"prompt_tokens": 0, "completion_tokens": 0, "cached": True, "latency": time.perf_counter() - start}
+        result, usage = await self._run_llm(prompt, temperature, max_tokens, opeani_api_keys, engine)
+        if self.cache is not None:
+            await self._off_loop(self.cache.put, prompt, temperature, max_tokens, engine, result)
+        self._record(prompt, result, engine, temperature)
+        usage = {"prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0), "cached": False, "latency": time.perf_counter() - start}
+        return result, usage
+
+    @staticmethod
+    async def _off_loop(func, *args):
+        # blocking calls (the SQLite cache) run in a thread so that the loop keeps serving the requests in flight
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _record(self, prompt, result, engine, temperature):
+        if self.recorder is not None:
+            self.recorder.record(prompt, result, engine, temperature)
+
+    @staticmethod
+    def _messages(prompt):
+        messages = [{"role":"system","content":SYSTEM_PROMPT}]
+        message_prompt = {"role":"user","content":prompt}
+        messages.append(message_prompt)
+        return messages
+
+    async def _run_llm(self, prompt, temperature, max_tokens, opeani_api_keys, engine):
+        messages = self._messages(prompt)
+
+        async def call(api_key):
+            async with self._get_semaphore():
+                return await asyncio.wait_for(self._create(messages, temperature, max_tokens, api_key, engine), self.timeout)
+
+        estimated_tokens = self.scheduler.estimate_tokens(prompt, max_tokens)
+        # keys of the scheduler's pool take precedence, `opeani_api_keys` is used when none were configured
+        return await self.scheduler.run(call, estimated_tokens, self.classify_error, opeani_api_keys)
+
+    async def _stream(self, messages, temperature, max_tokens, api_key, engine, should_stop):
+        chunks = []
+        stopped = False
+        usage = {}
+        stream = self.get_backend(engine).stream(messages, engine, temperature, max_tokens, api_key, self.timeout, usage)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                if should_stop("".join(chunks)):
+                    stopped = True
+                    break
+        finally:
+            await stream.aclose()
+        text = "".join(chunks)
+        if "total_tokens" not in usage:
+            # a cut stream (or a server without stream usage) reports nothing, the tokens are estimated
+            usage = {"prompt_tokens": len(messages[-1]["content"]) // 4, "completion_tokens": len(text) // 4}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return (text, stopped, usage), usage["total_tokens"]
+
+    async def run_llm_stream(self, prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo", should_stop=None):
+        """
+        Stream the completion and cancel it as soon as `should_stop(text so far)` is true.
+
+        Returns (completion, usage) like `run_llm_with_usage`, usage["stopped_early"] tells
+        whether the completion was cut. Cut completions are not cached, and their token
+        counts are estimated since the server only reports usage at the end of a stream.
+        """
+        start = time.perf_counter()
+        if self.cache is not None:
+            result = await self._off_loop(self.cache.get, prompt, temperature, max_tokens, engine)
+            if result is not None:
+                self._record(prompt, result, engine, temperature)
+                return result, {"prompt_tokens": 0, "completion_tokens": 0, "cached": True, "stopped_early": False, "latency": time.perf_counter() - start}
+        messages = self._messages(prompt)
+        should_stop = should_stop or (lambda text: False)
+
+        async def call(api_key):
+            async with self._get_semaphore():
+                return await asyncio.wait_for(self._stream(messages, temperature, max_tokens, api_key, engine, should_stop), self.timeout)
+
+        estimated_tokens = self.scheduler.estimate_tokens(prompt, max_tokens)
+        result, stopped_early, stream_usage = await self.scheduler.run(call, estimated_tokens, self.classify_error, opeani_api_keys)
+        if self.cache is not None and not stopped_early:
+            await self._off_loop(self.cache.put, prompt, temperature, max_tokens, engine, result)
+        self._record(prompt, result, engine, temperature)
+        usage = {"prompt_tokens": stream_usage.get("prompt_tokens", 0), "completion_tokens": stream_usage.get("completion_tokens", 0), "cached": False, "stopped_early": stopped_early, "latency": time.perf_counter() - start}
+        return result, usage
+
+    async def run_llm_many(self, prompts, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo", with_usage=False):
+        """Issue one call per prompt concurrently, results are returned in the order of `prompts`."""
+        run = self.run_llm_with_usage if with_usage else self.run_llm
+        return await asyncio.gather(*[run(prompt, temperature, max_tokens, opeani_api_keys, engine) for prompt in prompts])
+
+
+llm_client = AsyncLLMClient()
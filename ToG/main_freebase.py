@@ -1,91 +1,107 @@
 from tqdm import tqdm
 import argparse
+import threading
 from utils import *
 from freebase_func import *
 import random
 from client import *
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--dataset", type=str,
-                        default="webqsp", help="choose the dataset.")
-    parser.add_argument("--max_length", type=int,
-                        default=256, help="the max length of LLMs output.")
-    parser.add_argument("--temperature_exploration", type=float,
-                        default=0.4, help="the temperature in exploration stage.")
-    parser.add_argument("--temperature_reasoning", type=float,
-                        default=0, help="the temperature in reasoning stage.")
-    parser.add_argument("--width", type=int,
-                        default=3, help="choose the search width of ToG.")
-    parser.add_argument("--depth", type=int,
-                        default=3, help="choose the search depth of ToG.")
-    parser.add_argument("--remove_unnecessary_rel", type=bool,
-                        default=True, help="whether removing unnecessary relations.")
-    parser.add_argument("--LLM_type", type=str,
-                        default="gpt-3.5-turbo", help="base LLM model.")
-    parser.add_argument("--opeani_api_keys", type=str,
-                        default="", help="if the LLM_type is gpt-3.5-turbo or gpt-4, you need add your own openai api keys.")
-    parser.add_argument("--num_retain_entity", type=int,
-                        default=5, help="Number of entities retained during entities search.")
-    parser.add_argument("--prune_tools", type=str,
-                        default="llm", help="prune tools for ToG, can be llm (same as LLM_type), bm25 or sentencebert.")
-    args = parser.parse_args()
-
-    datas, question_string = prepare_dataset(args.dataset)
-    print("Start Running ToG on %s dataset." % args.dataset)
-    for data in tqdm(datas):
+def run_question(data, question_string, args, checkpoint, speculation_executor):
+    try:
+        start_question()
         question = data[question_string]
         topic_entity = data['topic_entity']
         cluster_chain_of_entities = []
         if len(topic_entity) == 0:
             results = generate_without_explored_paths(question, args)
             save_2_jsonl(question, results, [], file_name=args.dataset)
-            continue
+            return
         pre_relations = []
         pre_heads= [-1] * len(topic_entity)
         flag_printed = False
-        for depth in range(1, args.depth+1):
+        start_depth = 1
+        state = checkpoint.get(question)
+        if state is not None:
+            # resume after the last explored depth
+            start_depth = state["depth"] + 1
+            topic_entity, pre_relations, pre_heads = state["topic_entity"], state["pre_relations"], state["pre_heads"]
+            # triplets are tuples, they are printed as such in the prompts
+            cluster_chain_of_entities = [[[tuple(triplet) for triplet in chain] for chain in chain_of_entities] for chain_of_entities in state["cluster_chain_of_entities"]]
+        explored = None
+        for depth in range(start_depth, args.depth+1):
+            set_depth(depth)
+            budget = budget_exhausted(args)
+            if budget is not None:
+                budget_stop(question, cluster_chain_of_entities, budget, depth, args)
+                flag_printed = True
+                break
             current_entity_relations_list = []
-            i=0
-            for entity in topic_entity:
-                if entity!="[FINISH_ID]":
-                    retrieve_relations_with_scores = relation_search_prune(entity, topic_entity[entity], pre_relations, pre_heads[i], question, args)  # best entity triplet, entitiy_id
-                    current_entity_relations_list.extend(retrieve_relations_with_scores)
-                i+=1
-            total_candidates = []
-            total_scores = []
-            total_relations = []
-            total_entities_id = []
-            total_topic_entities = []
-            total_head = []
+            if explored is None and args.relation_query == "combined":
+                explored = search_frontier_relations(list(topic_entity), pre_relations, pre_heads, args)
+            searched = fan_out(search_relations, [(entity, topic_entity[entity], pre_relations, pre_heads[i], question, args, explored) for i, entity in enumerate(topic_entity) if entity!="[FINISH_ID]"])
+            for retrieve_relations_with_scores in searched:
+                current_entity_relations_list.extend(retrieve_relations_with_scores)  # best entity triplet, entitiy_id
+            explored = None
+            budget = budget_exhausted(args)
+            if budget is not None:
+                budget_stop(question, cluster_chain_of_entities, budget, depth, args)
+                flag_printed = True
+                break
+            frontier = Frontier()
 
-            for entity in current_entity_relations_list:
-                if entity['head']:
-                    entity_candidates_id = entity_search(entity['entity'], entity['relation'], True)
-                else:
-                    entity_candidates_id = entity_search(entity['entity'], entity['relation'], False)
-                
+            searched_relations = []
+            searched_candidates_id = []
+            searched_paths = []
+            if args.compound_hops:
+                searched = fan_out(entity_search_compound, [(entity['entity'], entity['relation'], entity['head'], args.entity_search_cap or 1000) for entity in current_entity_relations_list])
+            elif args.entity_search_cap:
+                searched = [(entity_candidates_id, reached, None) for entity_candidates_id, reached in fan_out(entity_search_capped, [(entity['entity'], entity['relation'], entity['head'], args.entity_search_cap, args.entity_search_random) for entity in current_entity_relations_list])]
+            else:
+                searched = [(entity_candidates_id, len(entity_candidates_id), None) for entity_candidates_id in fan_out(entity_search, [(entity['entity'], entity['relation'], entity['head']) for entity in current_entity_relations_list])]
+            for entity, (entity_candidates_id, reached, paths) in zip(current_entity_relations_list, searched):
                 if args.prune_tools == "llm":
-                    if len(entity_candidates_id) >=20:
-                        entity_candidates_id = random.sample(entity_candidates_id, args.num_retain_entity)
+                    if reached >=20:
+                        entity_candidates_id = random.sample(entity_candidates_id, min(args.num_retain_entity, len(entity_candidates_id)))
 
                 if len(entity_candidates_id) ==0:
                     continue
-                scores, entity_candidates, entity_candidates_id = entity_score(question, entity_candidates_id, entity['score'], entity['relation'], args)
-                
-                total_candidates, total_scores, total_relations, total_entities_id, total_topic_entities, total_head = update_history(entity_candidates, entity, scores, entity_candidates_id, total_candidates, total_scores, total_relations, total_entities_id, total_topic_entities, total_head)
-            
-            if len(total_candidates) ==0:
+                searched_relations.append(entity)
+                searched_candidates_id.append(entity_candidates_id)
+                searched_paths.append(paths)
+
+            # one batched name lookup for the whole depth, the scoring then reads the names from the memo
+            id2entity_names([entity_id for entity_candidates_id in searched_candidates_id for entity_id in entity_candidates_id])
+            if args.prune_tools == "llm" and args.entity_score_mode == "batch":
+                scored_candidates = entity_score_batch(question, searched_candidates_id, [entity['score'] for entity in searched_relations], [entity['relation'] for entity in searched_relations], args)
+            else:
+                scored_candidates = fan_out(entity_score, [(question, entity_candidates_id, entity['score'], entity['relation'], args) for entity, entity_candidates_id in zip(searched_relations, searched_candidates_id)])
+
+            for entity, paths, (scores, entity_candidates, entity_candidates_id) in zip(searched_relations, searched_paths, scored_candidates):
+                update_history(frontier, entity, entity_candidates, scores, entity_candidates_id, paths)
+        
+            if len(frontier) ==0:
                 half_stop(question, cluster_chain_of_entities, depth, args)
                 flag_printed = True
                 break
-                
-            flag, chain_of_entities, entities_id, pre_relations, pre_heads = entity_prune(total_entities_id, total_relations, total_candidates, total_topic_entities, total_head, total_scores, args)
+            
+            flag, chain_of_entities, entities_id, pre_relations, pre_heads = entity_prune(frontier, args)
             cluster_chain_of_entities.append(chain_of_entities)
             if flag:
+                budget = budget_exhausted(args)
+                if budget is not None:
+                    budget_stop(question, cluster_chain_of_entities, budget, depth, args)
+                    flag_printed = True
+                    break
+                speculation = None
+                if speculation_executor is not None and depth < args.depth:
+                    # the next depth only depends on the kept entities, explore it while the LLM checks this one
+                    cancelled = threading.Event()
+                    speculation = submit_in_context(speculation_executor, explore_next_depth, entities_id, pre_relations, pre_heads, question, args, cancelled)
                 stop, results = reasoning(question, cluster_chain_of_entities, args)
                 if stop:
+                    if speculation is not None:
+                        stop_speculation(speculation, cancelled)  # the explored depth is not needed anymore
                     print("ToG stoped at depth %d." % depth)
                     save_2_jsonl(question, results, cluster_chain_of_entities, file_name=args.dataset)
                     flag_printed = True
@@ -96,13 +112,153 @@ if __name__ == '__main__':
                     if flag_finish:
                         half_stop(question, cluster_chain_of_entities, depth, args)
                         flag_printed = True
+                        break
                     else:
-                        topic_entity = {entity: id2entity_name_or_type(entity) for entity in entities_id}
+                        if speculation is not None:
+                            topic_entity, explored = speculation.result()
+                        else:
+                            topic_entity = dict(zip(entities_id, id2entity_names(entities_id)))
+                        checkpoint.save(question, depth, cluster_chain_of_entities, topic_entity, pre_relations, pre_heads)
                         continue
             else:
                 half_stop(question, cluster_chain_of_entities, depth, args)
                 flag_printed = True
-        
+                break
+    
         if not flag_printed:
             results = generate_without_explored_paths(question, args)
             save_2_jsonl(question, results, [], file_name=args.dataset)
+    except LLMUnavailableError as e:
+        print("LLM unavailable, question skipped: %s" % e)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str,
+                        default="webqsp", help="choose the dataset.")
+    parser.add_argument("--max_length", type=int,
+                        default=256, help="the max length of LLMs output.")
+    parser.add_argument("--temperature_exploration", type=float,
+                        default=0.4, help="the temperature in exploration stage.")
+    parser.add_argument("--temperature_reasoning", type=float,
+                        default=0, help="the temperature in reasoning stage.")
+    parser.add_argument("--width", type=int,
+                        default=3, help="choose the search width of ToG.")
+    parser.add_argument("--depth", type=int,
+                        default=3, help="choose the search depth of ToG.")
+    parser.add_argument("--remove_unnecessary_rel", type=bool,
+                        default=True, help="whether removing unnecessary relations.")
+    parser.add_argument("--LLM_type", type=str,
+                        default="gpt-3.5-turbo", help="base LLM model.")
+    parser.add_argument("--opeani_api_keys", type=str,
+                        default="", help="if the LLM_type is gpt-3.5-turbo or gpt-4, you need add your own openai api keys, comma separated or a file with one key per line.")
+    parser.add_argument("--llm_backend", type=str,
+                        default="auto", help="LLM backend, can be openai, local (OpenAI-compatible local server), mock (offline deterministic), replay (serve a --llm_record file) or auto (local for llama, openai otherwise).")
+    parser.add_argument("--llm_api_base", type=str,
+                        default="", help="base url of the LLM backend, empty for the backend default.")
+    parser.add_argument("--llm_record", type=str,
+                        default="", help="file (gzip json lines) recording every LLM prompt hash and completion of the run, empty to disable.")
+    parser.add_argument("--llm_replay_file", type=str,
+                        default="", help="recording served by the replay backend, prompts not in it are answered heuristically.")
+    parser.add_argument("--llm_latency", type=float,
+                        default=0, help="synthetic latency in seconds of each call of the mock and replay backends.")
+    parser.add_argument("--llm_latency_per_token", type=float,
+                        default=0, help="additional synthetic latency in seconds per completion token of the mock and replay backends.")
+    parser.add_argument("--num_retain_entity", type=int,
+                        default=5, help="Number of entities retained during entities search.")
+    parser.add_argument("--prune_tools", type=str,
+                        default="llm", help="prune tools for ToG, can be llm (same as LLM_type), bm25 or sentencebert.")
+    parser.add_argument("--relation_token_budget", type=int,
+                        default=2000, help="max tokens of the relation list in a relation prune prompt, relations least related to the question are dropped beyond it, 0 for no limit.")
+    parser.add_argument("--entity_score_mode", type=str,
+                        default="single", help="how the llm prune tool scores entity candidates, single (one call per relation) or batch (one call per depth).")
+    parser.add_argument("--stream_reasoning", action="store_true",
+                        help="stream the sufficiency check and stop the generation as soon as its verdict is No.")
+    parser.add_argument("--speculative_exploration", type=str,
+                        default="none", help="explore the next depth while the sufficiency check runs, can be none, kg (KG lookups only) or prune (KG lookups and relation pruning).")
+    parser.add_argument("--num_workers", type=int,
+                        default=1, help="number of questions processed at once.")
+    parser.add_argument("--output_order", type=str,
+                        default="dataset", help="order of the records in the result file, dataset or completion (as the questions finish).")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the questions already in the result file and restart the explored ones from their last checkpointed depth.")
+    parser.add_argument("--fanout_workers", type=int,
+                        default=1, help="threads running the KG queries and LLM scoring calls of a depth concurrently, shared by all questions, 1 for serial.")
+    parser.add_argument("--kg_cache", type=str,
+                        default="", help="path of the local KG lookup cache (SQLite) read before the KG, empty to disable.")
+    parser.add_argument("--kg_prefetch", action="store_true",
+                        help="before the run, fetch the one-hop relations and neighbours of every topic entity of the dataset in bulk into --kg_cache.")
+    parser.add_argument("--kg_prefetch_batch", type=int,
+                        default=50, help="number of topic entities fetched per bulk KG query.")
+    parser.add_argument("--question_time_budget", type=float,
+                        default=0, help="seconds a question may take before its search stops and it is answered with the chains found so far, 0 for no limit.")
+    parser.add_argument("--question_call_budget", type=int,
+                        default=0, help="LLM calls a question may make before its search stops, 0 for no limit.")
+    parser.add_argument("--question_token_budget", type=int,
+                        default=0, help="LLM tokens (prompt + completion) a question may use before its search stops, 0 for no limit.")
+    parser.add_argument("--kg_store", type=str,
+                        default="", help="directory of a local subgraph store built by extract_subgraph.py, answering the KG lookups instead of Virtuoso, empty to query Virtuoso.")
+    parser.add_argument("--sparql_cache", type=str,
+                        default="", help="path of the on-disk SPARQL result cache (SQLite), shared by runs and concurrent processes, empty to disable.")
+    parser.add_argument("--sparql_cache_memory", type=int,
+                        default=10000, help="number of SPARQL results kept in memory in front of --sparql_cache.")
+    parser.add_argument("--sparql_cache_size", type=int,
+                        default=1000000, help="max number of SPARQL results kept in --sparql_cache, the least recently used ones are evicted.")
+    parser.add_argument("--sparql_cache_ttl", type=float,
+                        default=0, help="seconds a cached SPARQL result stays valid, 0 for ever.")
+    parser.add_argument("--sparql_cache_warm", type=str,
+                        default="", help="JSON lines file of {\"query\": ..., \"bindings\": [...]} records loaded into --sparql_cache at startup.")
+    parser.add_argument("--relation_query", type=str,
+                        default="split", help="how the relations of a depth are fetched, split (two queries per entity) or combined (one query for the whole frontier, filtered server side).")
+    parser.add_argument("--entity_search_cap", type=int,
+                        default=0, help="max entities fetched per (entity, relation) by the entity search, along with their count and names, 0 to fetch them all.")
+    parser.add_argument("--entity_search_random", action="store_true",
+                        help="with --entity_search_cap, let the KG sample the fetched entities at random instead of taking the first ones.")
+    parser.add_argument("--compound_hops", action="store_true",
+                        help="look through nameless mediator (CVT) nodes in the entity search, their named neighbours become candidates of a compound relation.")
+    parser.add_argument("--sparql_endpoints", type=str,
+                        default="", help="comma separated SPARQL endpoints of Virtuoso replicas, empty for $SPARQL_ENDPOINTS or SPARQLPATH of freebase_func.py.")
+    parser.add_argument("--sparql_timeout", type=float,
+                        default=60, help="timeout in seconds of a single SPARQL query before it is retried.")
+    parser.add_argument("--sparql_retries", type=int,
+                        default=3, help="number of retries of a failed SPARQL query, each on the next replica.")
+    parser.add_argument("--sparql_balance", type=str,
+                        default="round_robin", help="how queries are spread over the replicas, round_robin or least_loaded (fewest queries in flight).")
+    parser.add_argument("--llm_concurrency", type=int,
+                        default=8, help="max number of in-flight LLM requests.")
+    parser.add_argument("--llm_timeout", type=float,
+                        default=60, help="timeout in seconds of a single LLM request before it is retried.")
+    parser.add_argument("--llm_cache", type=str,
+                        default="", help="path of the on-disk LLM completion cache (SQLite), empty to disable.")
+    parser.add_argument("--llm_cache_size", type=int,
+                        default=100000, help="max number of completions kept in the LLM cache.")
+    parser.add_argument("--llm_cache_policy", type=str,
+                        default="deterministic", help="which LLM calls to cache, can be deterministic (temperature 0 only) or all.")
+    parser.add_argument("--llm_rpm", type=int,
+                        default=0, help="max LLM requests per minute of each api key, 0 for no limit.")
+    parser.add_argument("--llm_tpm", type=int,
+                        default=0, help="max LLM tokens (prompt + completion) per minute of each api key, 0 for no limit.")
+    parser.add_argument("--llm_max_retries", type=int,
+                        default=8, help="number of retries of a failed LLM call before the question is given up.")
+    parser.add_argument("--llm_retry_budget", type=float,
+                        default=600, help="max seconds spent retrying a single LLM call before the question is given up.")
+    parser.add_argument("--key_cooldown", type=float,
+                        default=60, help="seconds an api key is left unused after being throttled repeatedly.")
+    args = parser.parse_args()
+    setup_llm(args)
+    setup_sparql(args)
+    setup_fan_out(args.fanout_workers)
+    speculation_executor = ThreadPoolExecutor(max_workers=args.num_workers) if args.speculative_exploration != "none" else None
+
+    datas, question_string = prepare_dataset(args.dataset)
+    if args.kg_cache:
+        kg_cache.open(args.kg_cache)
+        if args.kg_prefetch:
+            prefetch_neighborhoods([entity for data in datas for entity in data['topic_entity']], args.kg_prefetch_batch)
+    print("Start Running ToG on %s dataset." % args.dataset)
+    run_questions(datas, lambda data, checkpoint: run_question(data, question_string, args, checkpoint, speculation_executor), args.dataset, question_string, args.num_workers, args.output_order == "dataset", args.resume)
+
+    report_llm_usage()
+    report_sparql_usage()
+    if args.kg_cache:
+        print("KG cache: %s" % kg_cache.stats())
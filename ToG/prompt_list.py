@@ -19,6 +19,19 @@ Q: {}
 Relation: {}
 Entites: """
 
+score_entity_candidates_batch_prompt = """Please score the entities' contribution to the question on a scale from 0 to 1, separately for each relation (the sum of the scores of the entities of each relation is 1). Give one line of scores per relation, numbered as the relations are.
+Q: The movie featured Miley Cyrus and was produced by Tobin Armbrust?
+1. Relation: film.producer.film
+Entites: The Resident; So Undercover; Let Me In; Begin Again; The Quiet Ones; A Walk Among the Tombstones
+2. Relation: film.film_story_contributor.film_story_credits
+Entites: The Resident; So Undercover
+Score:
+1. 0.0, 1.0, 0.0, 0.0, 0.0, 0.0
+2. 0.0, 1.0
+The movie that matches the given criteria is "So Undercover" with Miley Cyrus and produced by Tobin Armbrust. Therefore, the score for "So Undercover" would be 1 for both relations, and the scores for all other entities would be 0.
+
+Q: """
+
 answer_prompt = """Given a question and the associated retrieved knowledge graph triplets (entity, relation, entity), you are asked to answer the question with these triplets and your knowledge.
 Q: Find the person who said \"Taste cannot be controlled by law\", what did this person die from?
 Knowledge Triplets: Taste cannot be controlled by law., media_common.quotation.author, Thomas Jefferson
@@ -120,6 +133,19 @@ Q: {}
 Relation: {}
 Entites: """
 
+score_entity_candidates_batch_prompt_wiki = """Please score the entities' contribution to the question on a scale from 0 to 1, separately for each relation (the sum of the scores of the entities of each relation is 1). Give one line of scores per relation, numbered as the relations are.
+Q: Staten Island Summer, starred what actress who was a cast member of "Saturday Night Live"?
+1. Relation: cast member
+Entites: Ashley Greene; Bobby Moynihan; Camille Saviola; Cecily Strong; Colin Jost; Fred Armisen; Gina Gershon; Graham Phillips; Hassan Johnson; Jackson Nicoll; Jim Gaffigan; John DeLuca; Kate Walsh; Mary Birdsong
+2. Relation: director
+Entites: Rhys Thomas
+Score:
+1. 0.0, 0.0, 0.0, 0.4, 0.0, 0.2, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.4, 0.0
+2. 1.0
+We are looking for an actress who was a cast member of "Saturday Night Live" and starred in the movie "Staten Island Summer", so the actresses among the cast members who were also on "Saturday Night Live" get the highest scores. The director relation has a single entity, which gets the whole score.
+
+Q: """
+
 prompt_evaluate_wiki="""Given a question and the associated retrieved knowledge graph triplets (entity, relation, entity), you are asked to answer whether it's sufficient for you to answer the question with these triplets and your knowledge (Yes or No).
 Q: Viscount Yamaji Motoharu was a general in the early Imperial Japanese Army which belonged to which Empire?
 Knowledge Triplets: Imperial Japanese Army, allegiance, Emperor of Japan
@@ -0,0 +1,215 @@
+import asyncio
+import os
+import random
+import time
+
+
+class LLMUnavailableError(Exception):
+    """Raised when an LLM call is given up, either because it failed permanently or because its retry budget ran out."""
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`, holding at most one minute of budget.
+
+    A rate of 0 disables the bucket. Requests larger than the capacity are let through
+    once the bucket is full, otherwise they would wait forever.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        if self.rate == 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def remaining(self):
+        """Fraction of the budget currently available, 1.0 for an unlimited bucket."""
+        if self.rate == 0:
+            return 1.0
+        self._refill()
+        return max(self.level, 0) / self.capacity
+
+    def consume(self, amount):
+        if self.rate == 0:
+            return
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount):
+        if self.rate == 0:
+            return
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+def load_api_keys(opeani_api_keys):
+    """Keys are given either as a comma separated list or as a file with one key per line."""
+    if opeani_api_keys and os.path.isfile(opeani_api_keys):
+        with open(opeani_api_keys) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return [key.strip() for key in opeani_api_keys.split(",") if key.strip()]
+
+
+def mask_key(key):
+    return key[:3] + "..." + key[-4:] if len(key) > 8 else key
+
+
+class APIKey:
+    def __init__(self, key, requests_per_minute, tokens_per_minute):
+        self.key = key
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.requests = 0
+        self.tokens = 0
+        self.throttles = 0
+        self.consecutive_throttles = 0
+        self.cooldowns = 0
+
+    def wait_time(self, estimated_tokens):
+        return max(self.paused_until - time.monotonic(), self.request_bucket.wait_time(1), self.token_bucket.wait_time(estimated_tokens))
+
+    def remaining(self):
+        return min(self.request_bucket.remaining(), self.token_bucket.remaining())
+
+
+class APIKeyPool:
+    """
+    Routes every LLM call to the API key with the most remaining quota.
+
+    Each key has its own requests/tokens per minute buckets. A throttled key is paused for
+    the retry-after delay, and a key throttled `max_consecutive_throttles` times in a row is
+    put in cool-down for `cooldown` seconds so the other keys take its traffic.
+    """
+
+    def __init__(self, keys, requests_per_minute=0, tokens_per_minute=0, cooldown=60, max_consecutive_throttles=3):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.cooldown = cooldown
+        self.max_consecutive_throttles = max_consecutive_throttles
+        self.keys = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        if key not in self.keys:
+            self.keys[key] = APIKey(key, self.requests_per_minute, self.tokens_per_minute)
+        return self.keys[key]
+
+    async def acquire(self, estimated_tokens, default_key=""):
+        if not self.keys:
+            self.add(default_key)
+        while True:
+            ready = [key for key in self.keys.values() if key.wait_time(estimated_tokens) <= 0]
+            if ready:
+                key = max(ready, key=lambda key: (key.remaining(), -key.requests))
+                key.request_bucket.consume(1)
+                key.token_bucket.consume(estimated_tokens)
+                key.requests += 1
+                return key
+            await asyncio.sleep(min(key.wait_time(estimated_tokens) for key in self.keys.values()))
+
+    def report_success(self, key, estimated_tokens, used_tokens):
+        key.consecutive_throttles = 0
+        if used_tokens is not None:
+            key.tokens += used_tokens
+            if used_tokens < estimated_tokens:
+                key.token_bucket.refund(estimated_tokens - used_tokens)
+            else:
+                key.token_bucket.consume(used_tokens - estimated_tokens)
+
+    def report_throttle(self, key, delay):
+        key.throttles += 1
+        key.consecutive_throttles += 1
+        if key.consecutive_throttles >= self.max_consecutive_throttles:
+            key.cooldowns += 1
+            key.consecutive_throttles = 0
+            delay = max(delay, self.cooldown)
+            print("API key %s throttled repeatedly, cooling down for %ds." % (mask_key(key.key), delay))
+        key.paused_until = max(key.paused_until, time.monotonic() + delay)
+
+    def usage(self):
+        return [{"key": mask_key(key.key), "requests": key.requests, "tokens": key.tokens, "throttles": key.throttles, "cooldowns": key.cooldowns} for key in self.keys.values()]
+
+
+class RateLimitScheduler:
+    """
+    Paces the LLM calls of a run and decides how failed calls are retried.
+
+    Requests and tokens per minute are enforced per API key by an `APIKeyPool`. A throttled
+    call pauses its key until the server's retry-after hint (or an exponential backoff with
+    full jitter when there is none) has passed, so workers do not retry in lock step and the
+    other keys keep serving. A call is given up with `LLMUnavailableError` after
+    `max_retries` retries or once `retry_budget` seconds have been spent on it.
+    """
+
+    def __init__(self, key_pool=None, max_retries=8, retry_budget=600, backoff_base=1.0, backoff_cap=60.0):
+        self.key_pool = key_pool or APIKeyPool([])
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.throttled = 0
+        self.retried = 0
+        self.given_up = 0
+
+    @staticmethod
+    def estimate_tokens(prompt, max_tokens):
+        # about 4 characters per token for English text, plus the completion budget
+        return len(prompt) // 4 + max_tokens
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def run(self, call, estimated_tokens, classify_error, default_key=""):
+        """
+        Run `call(api_key)` (a coroutine function returning (result, used_tokens)) under the rate limits.
+
+        `classify_error(exception)` returns (retryable, throttled, retry_after) for a failed call.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            key = await self.key_pool.acquire(estimated_tokens, default_key)
+            try:
+                result, used_tokens = await call(key.key)
+                self.key_pool.report_success(key, estimated_tokens, used_tokens)
+                return result
+            except Exception as e:
+                retryable, throttled, retry_after = classify_error(e)
+                if not retryable:
+                    self.given_up += 1
+                    raise LLMUnavailableError("LLM call failed permanently: %r" % e) from e
+                delay = self.backoff(attempt, retry_after)
+                attempt += 1
+                if attempt > self.max_retries or time.monotonic() - start + delay > self.retry_budget:
+                    self.given_up += 1
+                    raise LLMUnavailableError("LLM call given up after %d attempts in %.0fs: %r" % (attempt, time.monotonic() - start, e)) from e
+                self.retried += 1
+                if throttled:
+                    # only the key is paused, so the retry can go out at once on another key
+                    print("LLM throttled on key %s, key paused for %.1fs, retry %d" % (mask_key(key.key), delay, attempt))
+                    self.throttled += 1
+                    self.key_pool.report_throttle(key, delay)
+                else:
+                    print("LLM error %r, retry %d in %.1fs" % (e, attempt, delay))
+                    await asyncio.sleep(delay)
+
+    def stats(self):
+        return {"retried": self.retried, "throttled": self.throttled, "given_up": self.given_up}
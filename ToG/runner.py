@@ -0,0 +1,184 @@
+import contextvars
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+
+_records = contextvars.ContextVar("records", default=None)
+
+
+def result_path(file_name):
+    return "ToG_{}.jsonl".format(file_name)
+
+
+def checkpoint_path(file_name):
+    return "ToG_{}.checkpoint.jsonl".format(file_name)
+
+
+def emit_record(record, file_name):
+    """Hand a result record to the runner of the current question, or append it to the result file when there is none."""
+    records = _records.get()
+    if records is not None:
+        records.append(record)
+    else:
+        with open(result_path(file_name), "a") as outfile:
+            outfile.write(json.dumps(record) + "\n")
+
+
+def load_finished_questions(path):
+    """Questions that already have a record in the result file, which is read line by line."""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path) as f:
+        for line in f:
+            try:
+                finished.add(json.loads(line)["question"])
+            except (ValueError, KeyError):
+                continue  # record cut by a crash
+    return finished
+
+
+def drop_partial_line(path, chunk_size=1 << 16):
+    """Cut a file back to its last complete line, left behind by a crash in the middle of a write."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            f.truncate(position)
+
+
+class Checkpoint:
+    """
+    Per-depth progress of the questions being explored, appended to a JSON lines file.
+
+    After every depth that did not answer its question, the reasoning chains and the frontier
+    (topic entities, the relations that led to them and their directions) are saved, so that
+    a resumed run restarts the question at the next depth instead of from scratch. On start,
+    the file is compacted to the last state of each unfinished question, or emptied when
+    `finished` is None (not resuming).
+    """
+
+    def __init__(self, path, finished=None):
+        self.path = path
+        self.states = {}
+        if finished is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        state = json.loads(line)
+                    except ValueError:
+                        continue
+                    if state["question"] not in finished:
+                        self.states[state["question"]] = state
+        with open(path + ".tmp", "w") as f:
+            for state in self.states.values():
+                f.write(json.dumps(state) + "\n")
+        os.replace(path + ".tmp", path)
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def get(self, question):
+        return self.states.get(question)
+
+    def save(self, question, depth, cluster_chain_of_entities, topic_entity, pre_relations, pre_heads):
+        line = json.dumps({"question": question, "depth": depth, "cluster_chain_of_entities": cluster_chain_of_entities,
+                           "topic_entity": topic_entity, "pre_relations": pre_relations, "pre_heads": pre_heads})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ResultWriter:
+    """
+    The only writer of the result file of a run.
+
+    With `ordered`, records are written in dataset order: the records of a question that
+    finished early are held back until every question before it has been written.
+    """
+
+    def __init__(self, path, ordered=True):
+        self.ordered = ordered
+        self.next_index = 0
+        self.pending = {}
+        self._lock = threading.Lock()
+        drop_partial_line(path)
+        self._file = open(path, "a")
+
+    def write(self, index, records):
+        with self._lock:
+            if not self.ordered:
+                self._write(records)
+                return
+            self.pending[index] = records
+            while self.next_index in self.pending:
+                self._write(self.pending.pop(self.next_index))
+                self.next_index += 1
+
+    def _write(self, records):
+        for record in records:
+            self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            # questions held back behind one that never finished
+            for index in sorted(self.pending):
+                self._write(self.pending[index])
+            self.pending = {}
+            self._file.close()
+
+
+def run_questions(datas, solve, file_name, question_string, num_workers=1, ordered=True, resume=False):
+    """
+    Solve the questions of `datas` on `num_workers` threads, `solve(data, checkpoint)` handles one question.
+
+    Each question runs in a fresh context, so its stats and records never mix with those of
+    another question, and its records reach the result file through a single `ResultWriter`.
+    The LLM client bounds the requests in flight, so extra workers only add throughput
+    until the LLM rate limits are reached. With `resume`, questions that already have a
+    record are skipped and the explored ones restart from their last checkpointed depth.
+    """
+    finished = None
+    if resume:
+        finished = load_finished_questions(result_path(file_name))
+        datas = [data for data in datas if data[question_string] not in finished]
+        print("Resuming, %d questions already done, %d left." % (len(finished), len(datas)))
+    checkpoint = Checkpoint(checkpoint_path(file_name), finished)
+    if resume and checkpoint.states:
+        print("%d questions restart from a checkpointed depth." % len(checkpoint.states))
+    writer = ResultWriter(result_path(file_name), ordered)
+
+    def run(data):
+        records = []
+        context = contextvars.copy_context()
+        context.run(_records.set, records)
+        context.run(solve, data, checkpoint)
+        return records
+
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="question")
+    try:
+        futures = {executor.submit(run, data): index for index, data in enumerate(datas)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            writer.write(futures[future], future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+        checkpoint.close()
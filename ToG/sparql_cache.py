@@ -0,0 +1,129 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SPARQLCache:
+    """
+    Two-tier cache of SPARQL results keyed by the query text, whitespace normalised.
+
+    Results are first looked up in an in-process LRU of `memory_entries` queries, then in a
+    SQLite file shared by the runs and by concurrent processes (WAL, writers wait on each
+    other). When the file holds more than `max_entries` results, the least recently used
+    ones are evicted. With a `ttl` (seconds), older results are treated as missing. Results
+    are kept as JSON and decoded on every hit, so callers may modify what they get. Hits do
+    not write to the file: their access times are kept in memory and written with the next
+    insert, every `ACCESS_BATCH` hits, and on `close`.
+    """
+
+    ACCESS_BATCH = 1000
+
+    def __init__(self, path, memory_entries=10000, max_entries=1000000, ttl=0):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._accessed = {}  # query hash -> last access not yet written
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS results (
+            query_hash TEXT PRIMARY KEY, bindings TEXT, created REAL, last_access REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @staticmethod
+    def query_hash(sparql_query):
+        return hashlib.sha256(" ".join(sparql_query.split()).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, created, bindings):
+        self._memory[key] = (created, bindings)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _expired(self, created):
+        return self.ttl and created < time.time() - self.ttl
+
+    def get(self, sparql_query):
+        key = self.query_hash(sparql_query)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self._access(key)
+                return json.loads(entry[1])
+            row = self._conn.execute("SELECT created, bindings FROM results WHERE query_hash=?", (key,)).fetchone()
+            if row is None or self._expired(row[0]):
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row[0], row[1])
+            self._access(key)
+        return json.loads(row[1])
+
+    def _access(self, key):
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= self.ACCESS_BATCH:
+            self._write_accesses()
+            self._conn.commit()
+
+    def _write_accesses(self):
+        self._conn.executemany("UPDATE results SET last_access=? WHERE query_hash=?", [(accessed, key) for key, accessed in self._accessed.items()])
+        self._accessed = {}
+
+    def put(self, sparql_query, bindings):
+        self.put_many([(sparql_query, bindings)])
+
+    def put_many(self, items):
+        """Store (query, bindings) pairs."""
+        now = time.time()
+        rows = [(self.query_hash(sparql_query), json.dumps(bindings), now, now) for sparql_query, bindings in items]
+        with self._lock:
+            for key, bindings, created, _ in rows:
+                self._remember(key, created, bindings)
+            cursor = self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+            # replaced rows and the inserts of other processes make this an estimate, `_evict` counts the rows
+            self._size += cursor.rowcount
+            self._write_accesses()
+            if self._size > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        self._size = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if self._size <= self.max_entries:
+            return
+        # drop a tenth of the file at once so that eviction does not run on every insert
+        n_evict = self._size - self.max_entries + max(1, self.max_entries // 10)
+        self._conn.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_access LIMIT ?)", (n_evict,))
+        self._size = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def warm(self, path):
+        """Load a JSON lines file of {"query": ..., "bindings": [...]} records, returns the number loaded."""
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        items = [(record["query"], record["bindings"]) for record in records]
+        self.put_many(items)
+        return len(items)
+
+    def stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses, "hit_rate": hits / total if total else 0.0, "entries": self._size}
+
+    def close(self):
+        with self._lock:
+            self._write_accesses()
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,97 @@
+import itertools
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SPARQLError(Exception):
+    def __init__(self, status, message):
+        super().__init__("HTTP %d: %s" % (status, message))
+        self.status = status
+
+
+class SPARQLClient:
+    """
+    Thread-safe SPARQL client over keep-alive HTTP connections to one or more Virtuoso replicas.
+
+    Each thread gets its own pooled `requests.Session`, so connections are reused across
+    queries instead of being opened for each of them. Queries go to the replicas in turn
+    (round_robin) or to the one with the fewest queries in flight (least_loaded). A query
+    that fails with a connection error, a timeout or a 5xx is retried on the next replica
+    with exponential backoff, and the failed replica is left out for `cooldown` seconds unless
+    all of them are down. Other HTTP errors (a malformed query) are raised at once.
+    """
+
+    def __init__(self, endpoints, timeout=60, max_retries=3, balance="round_robin", pool_size=16, cooldown=30):
+        if balance not in ("round_robin", "least_loaded"):
+            raise ValueError("unknown SPARQL balancing %s, you should pick from {round_robin, least_loaded}." % balance)
+        self.endpoints = list(endpoints)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.balance = balance
+        self.pool_size = pool_size
+        self.cooldown = cooldown
+        self._down_until = {endpoint: 0.0 for endpoint in self.endpoints}
+        self._in_flight = {endpoint: 0 for endpoint in self.endpoints}
+        self._queries = {endpoint: 0 for endpoint in self.endpoints}
+        self._failures = {endpoint: 0 for endpoint in self.endpoints}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+        return self._local.session
+
+    def _acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            endpoints = [endpoint for endpoint in self.endpoints if self._down_until[endpoint] <= now] or self.endpoints
+            if self.balance == "least_loaded":
+                endpoint = min(endpoints, key=self._in_flight.get)
+            else:
+                endpoint = endpoints[next(self._turn) % len(endpoints)]
+            self._in_flight[endpoint] += 1
+            self._queries[endpoint] += 1
+        return endpoint
+
+    def _release(self, endpoint, failed, down=False):
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+            if failed:
+                self._failures[endpoint] += 1
+            if down:
+                self._down_until[endpoint] = time.monotonic() + self.cooldown
+
+    def _post(self, endpoint, sparql_query):
+        response = self.session.post(endpoint, data={"query": sparql_query}, headers={"Accept": "application/sparql-results+json"}, timeout=self.timeout)
+        if response.status_code != 200:
+            raise SPARQLError(response.status_code, response.text[:200])
+        return response.json()["results"]["bindings"]
+
+    def query(self, sparql_query):
+        """Bindings of a SELECT query."""
+        for attempt in range(self.max_retries + 1):
+            endpoint = self._acquire()
+            try:
+                bindings = self._post(endpoint, sparql_query)
+            except (requests.ConnectionError, requests.Timeout, SPARQLError) as e:
+                retryable = not isinstance(e, SPARQLError) or e.status >= 500
+                self._release(endpoint, True, retryable)
+                if not retryable or attempt == self.max_retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+            self._release(endpoint, False)
+            return bindings
+
+    def stats(self):
+        with self._lock:
+            return [{"endpoint": endpoint, "queries": self._queries[endpoint], "failures": self._failures[endpoint]} for endpoint in self.endpoints]
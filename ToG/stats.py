@@ -0,0 +1,162 @@
+import contextvars
+import functools
+import threading
+import time
+
+
+_question_stats = contextvars.ContextVar("question_stats", default=None)
+_stage = contextvars.ContextVar("stage", default="other")
+
+
+def _new_counter():
+    return {"calls": 0, "cached_calls": 0, "early_stops": 0, "prompt_tokens": 0, "completion_tokens": 0, "llm_seconds": 0.0, "wall_seconds": 0.0, "dropped_relations": 0}
+
+
+class QuestionStats:
+    """LLM calls, tokens and time of one question, broken down by search stage and by depth."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.depth = 0
+        self.stages = {}
+        self.depths = {}
+        self.latencies = {}  # stage -> latency of every LLM call, for the run percentiles
+        self._lock = threading.Lock()  # a question may record from several threads
+
+    def _counters(self, stage):
+        return self.stages.setdefault(stage, _new_counter()), self.depths.setdefault(str(self.depth), _new_counter())
+
+    def record_llm_call(self, stage, usage, latency):
+        with self._lock:
+            for counter in self._counters(stage):
+                counter["calls"] += 1
+                counter["cached_calls"] += int(usage.get("cached", False))
+                counter["early_stops"] += int(usage.get("stopped_early", False))
+                counter["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                counter["completion_tokens"] += usage.get("completion_tokens", 0)
+                counter["llm_seconds"] += latency
+            self.latencies.setdefault(stage, []).append(latency)
+
+    def record_stage_time(self, stage, elapsed):
+        with self._lock:
+            for counter in self._counters(stage):
+                counter["wall_seconds"] += elapsed
+
+    def record_dropped_relations(self, stage, dropped):
+        with self._lock:
+            for counter in self._counters(stage):
+                counter["dropped_relations"] += dropped
+
+    def _snapshot(self):
+        """Copies of the stage and depth counters, taken while no thread records."""
+        with self._lock:
+            return {stage: dict(counter) for stage, counter in self.stages.items()}, {depth: dict(counter) for depth, counter in self.depths.items()}
+
+    @staticmethod
+    def _total(stages, start):
+        total = _new_counter()
+        for counter in stages.values():
+            for k in total:
+                total[k] += counter[k]
+        total["wall_seconds"] = time.perf_counter() - start
+        return total
+
+    def stage_latencies(self):
+        with self._lock:
+            return {stage: list(latencies) for stage, latencies in self.latencies.items()}
+
+    def totals(self):
+        return self._total(self._snapshot()[0], self.start)
+
+    def to_dict(self):
+        stages, depths = self._snapshot()
+        round_counter = lambda counter: {k: round(v, 4) if isinstance(v, float) else v for k, v in counter.items()}
+        return {"total": round_counter(self._total(stages, self.start)),
+                "stages": {stage: round_counter(counter) for stage, counter in stages.items()},
+                "depths": {depth: round_counter(counter) for depth, counter in depths.items()}}
+
+
+def start_question():
+    stats = QuestionStats()
+    _question_stats.set(stats)
+    return stats
+
+
+def current_stats():
+    return _question_stats.get()
+
+
+def set_depth(depth):
+    stats = _question_stats.get()
+    if stats is not None:
+        stats.depth = depth
+
+
+def record_llm_call(usage, latency):
+    stats = _question_stats.get()
+    if stats is not None:
+        stats.record_llm_call(_stage.get(), usage, latency)
+
+
+def record_dropped_relations(dropped):
+    stats = _question_stats.get()
+    if stats is not None:
+        stats.record_dropped_relations(_stage.get(), dropped)
+
+
+def track_stage(stage):
+    """Decorator attributing the wall time and the LLM calls of a function to a search stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = _question_stats.get()
+            if stats is None or _stage.get() == stage:
+                return func(*args, **kwargs)
+            token = _stage.set(stage)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.record_stage_time(stage, time.perf_counter() - start)
+                _stage.reset(token)
+        return wrapper
+    return decorator
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class RunStats:
+    """Aggregates the stats of the finished questions of a run."""
+
+    def __init__(self):
+        self.questions = []
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def add(self, stats):
+        with self._lock:
+            self.questions.append(stats.totals())
+            for stage, latencies in stats.stage_latencies().items():
+                self.latencies.setdefault(stage, []).extend(latencies)
+
+    def summary(self):
+        lines = ["Run summary over %d questions:" % len(self.questions)]
+        if not self.questions:
+            return "\n".join(lines)
+        tokens = [q["prompt_tokens"] + q["completion_tokens"] for q in self.questions]
+        calls = [q["calls"] for q in self.questions]
+        seconds = [q["wall_seconds"] for q in self.questions]
+        lines.append("  per question: %.1f LLM calls, %.0f tokens (p50 %.0f, p95 %.0f), %.2fs (p50 %.2fs, p95 %.2fs)" % (
+            sum(calls) / len(calls), sum(tokens) / len(tokens), percentile(tokens, 50), percentile(tokens, 95),
+            sum(seconds) / len(seconds), percentile(seconds, 50), percentile(seconds, 95)))
+        for stage, latencies in sorted(self.latencies.items()):
+            lines.append("  %s: %d LLM calls, latency p50 %.2fs, p95 %.2fs" % (stage, len(latencies), percentile(latencies, 50), percentile(latencies, 95)))
+        return "\n".join(lines)
+
+
+run_stats = RunStats()
@@ -0,0 +1,62 @@
+from argparse import Namespace
+import freebase_func
+
+NS = "http://rdf.freebase.com/ns/"
+
+
+def _rows(marker, head_value, tail_value):
+    rows = []
+    for relation, value in (("people.person.nationality", head_value), ("location.location.people_born_here", tail_value)):
+        row = {"entity": {"type": "uri", "value": NS + "m.01"}, "relation": {"type": "uri", "value": NS + relation}}
+        row[marker] = value
+        rows.append(row)
+    return rows
+
+
+def _frontier_relations(monkeypatch, rows):
+    queries = []
+    monkeypatch.setattr(freebase_func, "execurte_sparql", lambda query, cache=True: queries.append(query) or rows)
+    monkeypatch.setattr(freebase_func, "kg_store", None)
+    relations = freebase_func.frontier_relations(["m.01"], Namespace(remove_unnecessary_rel=False))
+    return relations, queries
+
+
+def test_frontier_relations_direction_marker(monkeypatch):
+    rows = _rows("dir", {"type": "literal", "value": "head"}, {"type": "literal", "value": "tail"})
+    relations, queries = _frontier_relations(monkeypatch, rows)
+    assert relations == {"m.01": (["people.person.nationality"], ["location.location.people_born_here"])}
+    assert 'BIND("head" AS ?dir)' in queries[0] and "BIND(true" not in queries[0]
+
+
+def test_frontier_relations_boolean_as_number(monkeypatch):
+    # Virtuoso 7 serializes xsd:boolean as "1"/"0"
+    boolean = "http://www.w3.org/2001/XMLSchema#boolean"
+    rows = _rows("head", {"type": "typed-literal", "datatype": boolean, "value": "1"}, {"type": "typed-literal", "datatype": boolean, "value": "0"})
+    relations, _ = _frontier_relations(monkeypatch, rows)
+    assert relations == {"m.01": (["people.person.nationality"], ["location.location.people_born_here"])}
+
+
+def test_frontier_relations_boolean_as_word(monkeypatch):
+    boolean = "http://www.w3.org/2001/XMLSchema#boolean"
+    rows = _rows("head", {"type": "literal", "datatype": boolean, "value": "true"}, {"type": "literal", "datatype": boolean, "value": "false"})
+    relations, _ = _frontier_relations(monkeypatch, rows)
+    assert relations == {"m.01": (["people.person.nationality"], ["location.location.people_born_here"])}
+
+
+def test_entity_search_capped_samples_cached_entities(monkeypatch):
+    cached = ["m.%02d" % i for i in range(20)]
+    monkeypatch.setattr(freebase_func, "kg_store", None)
+    monkeypatch.setattr(freebase_func.kg_cache, "get", lambda kind, *args: list(cached))
+    monkeypatch.setattr(freebase_func.random, "sample", lambda population, k: population[::-1][:k])
+    assert freebase_func.entity_search_capped("m.01", "people.person.children", True, 5) == (cached[:5], 20)
+    assert freebase_func.entity_search_capped("m.01", "people.person.children", True, 5, randomize=True) == (cached[::-1][:5], 20)
+    assert freebase_func.entity_search_capped("m.01", "people.person.children", True, 50, randomize=True) == (cached[::-1], 20)
+
+
+def test_entity_search_compound_marks_inverse_first_hop(monkeypatch):
+    rows = [{"tailEntity": {"type": "uri", "value": NS + "m.02"}, "name": {"type": "literal", "value": "Named"}},
+            {"tailEntity": {"type": "uri", "value": NS + "m.03"}, "name": {"type": "literal", "value": "Behind a CVT"}, "relation": {"type": "uri", "value": NS + "film.performance.film"}}]
+    monkeypatch.setattr(freebase_func, "execurte_sparql", lambda query, cache=True: rows)
+    monkeypatch.setattr(freebase_func, "kg_store", None)
+    assert freebase_func.entity_search_compound("m.01", "film.actor.film", True)[2] == {"m.03": ("film.actor.film.film.performance.film", True)}
+    assert freebase_func.entity_search_compound("m.01", "film.performance.actor", False)[2] == {"m.03": ("^film.performance.actor.film.performance.film", True)}
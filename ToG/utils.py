@@ -1,8 +1,17 @@
 from prompt_list import *
 import json
 import time
-import openai
 import re
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from llm_client import llm_client
+from llm_cache import CompletionCache
+from llm_backends import get_backend, LLMRecorder
+from stats import track_stage, start_question, set_depth, current_stats, record_llm_call, record_dropped_relations, run_stats
+from rate_limit import RateLimitScheduler, APIKeyPool, LLMUnavailableError, load_api_keys
+from runner import emit_record, run_questions
+from kg_cache import kg_cache
+from tqdm import tqdm
 from prompt_list import *
 from rank_bm25 import BM25Okapi
 from sentence_transformers import util
@@ -62,6 +71,35 @@ def compute_bm25_similarity(query, corpus, width=3):
     return relations, doc_scores
 
 
+def _words(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def fit_relations_to_budget(question, entity_name, relations, token_budget):
+    """
+    Cut the relation list of a prune prompt down to `token_budget` tokens (about 4 characters each).
+
+    Hub entities can have thousands of relations. The ones sharing the most words with the
+    question (BM25 over the words of the relation names) are kept until the budget is spent,
+    in their original order. A budget of 0 keeps every relation.
+    """
+    if token_budget <= 0 or sum(len(relation) + 2 for relation in relations) <= 4 * token_budget:
+        return relations
+    bm25 = BM25Okapi([_words(relation) or [relation] for relation in relations])
+    scores = bm25.get_scores(_words(question))
+    kept = []
+    budget = 4 * token_budget
+    for i in sorted(range(len(relations)), key=lambda i: (-scores[i], i)):
+        budget -= len(relations[i]) + 2
+        if budget < 0:
+            break
+        kept.append(i)
+    dropped = len(relations) - len(kept)
+    print("Relation list of %s cut from %d to %d relations to fit %d tokens." % (entity_name, len(relations), len(kept), token_budget))
+    record_dropped_relations(dropped)
+    return [relations[i] for i in sorted(kept)]
+
+
 def clean_relations(string, entity_id, head_relations):
     pattern = r"{\s*(?P<relation>[^()]+)\s+\(Score:\s+(?P<score>[0-9.]+)\)}"
     relations=[]
@@ -103,35 +141,98 @@ def clean_relations_bm25_sent(topn_relations, topn_scores, entity_id, head_relat
     return True, relations
 
 
+def setup_llm(args):
+    cache = None
+    if args.llm_cache:
+        cache = CompletionCache(args.llm_cache, args.llm_cache_size, args.llm_cache_policy)
+    key_pool = APIKeyPool(load_api_keys(args.opeani_api_keys), args.llm_rpm, args.llm_tpm, args.key_cooldown)
+    scheduler = RateLimitScheduler(key_pool, args.llm_max_retries, args.llm_retry_budget)
+    backend = get_backend(args.llm_backend, args.LLM_type, args.llm_api_base, args.llm_concurrency, args.llm_replay_file, args.llm_latency, args.llm_latency_per_token)
+    recorder = LLMRecorder(args.llm_record) if args.llm_record else None
+    llm_client.configure(concurrency=args.llm_concurrency, timeout=args.llm_timeout, cache=cache, scheduler=scheduler, backend=backend, recorder=recorder)
+    # resolve the served model once at startup instead of on every call
+    llm_client.run_sync(backend.resolve_model(args.LLM_type))
+
+
+def report_llm_usage():
+    if llm_client.recorder is not None:
+        llm_client.recorder.close()
+        print("LLM recorder: %d completions written to %s." % (llm_client.recorder.recorded, llm_client.recorder.path))
+    if llm_client.backend is not None and llm_client.backend.name == "replay":
+        stats = llm_client.backend.stats()
+        print("LLM replay: %d recorded answers served, %d prompts answered heuristically (%d recorded with another engine or temperature only)." % (stats["hits"], stats["misses"], stats["mismatches"]))
+    stats = llm_client.scheduler.stats()
+    print("LLM calls: %d retried, %d throttled, %d given up." % (stats["retried"], stats["throttled"], stats["given_up"]))
+    for usage in llm_client.scheduler.key_pool.usage():
+        print("API key %s: %d requests, %d tokens, %d throttled, %d cool-downs." % (usage["key"], usage["requests"], usage["tokens"], usage["throttles"], usage["cooldowns"]))
+    print(run_stats.summary())
+    if llm_client.cache is not None:
+        stats = llm_client.cache.stats()
+        print("LLM cache: %d hits, %d misses (hit rate %.2f%%), %d entries." % (stats["hits"], stats["misses"], stats["hit_rate"] * 100, stats["entries"]))
+        llm_client.cache.close()
+    llm_client.run_sync(llm_client.close())
+
+
 def run_llm(prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
-    if "llama" in engine.lower():
-        openai.api_key = "EMPTY"
-        openai.api_base = "http://localhost:8000/v1"  # your local llama server port
-        engine = openai.Model.list()["data"][0]["id"]
-    else:
-        openai.api_key = opeani_api_keys
+    result, usage = llm_client.run_sync(llm_client.run_llm_with_usage(prompt, temperature, max_tokens, opeani_api_keys, engine))
+    record_llm_call(usage, usage["latency"])
+    return result
 
-    messages = [{"role":"system","content":"You are an AI assistant that helps people find information."}]
-    message_prompt = {"role":"user","content":prompt}
-    messages.append(message_prompt)
-    f = 0
-    while(f == 0):
-        try:
-            response = openai.ChatCompletion.create(
-                    model=engine,
-                    messages = messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    frequency_penalty=0,
-                    presence_penalty=0)
-            result = response["choices"][0]['message']['content']
-            f = 1
-        except:
-            print("openai error, retry")
-            time.sleep(2)
+
+def run_llm_streaming(prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo", should_stop=None):
+    """Same as run_llm, but the generation is cancelled as soon as should_stop(text so far) is true."""
+    result, usage = llm_client.run_sync(llm_client.run_llm_stream(prompt, temperature, max_tokens, opeani_api_keys, engine, should_stop))
+    record_llm_call(usage, usage["latency"])
     return result
 
+
+async def run_llm_async(prompt, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
+    return await llm_client.run_llm(prompt, temperature, max_tokens, opeani_api_keys, engine)
+
+
+def run_llm_batch(prompts, temperature, max_tokens, opeani_api_keys, engine="gpt-3.5-turbo"):
+    """Send all prompts at once (bounded by --llm_concurrency) and return the completions in order."""
+    results = llm_client.run_sync(llm_client.run_llm_many(prompts, temperature, max_tokens, opeani_api_keys, engine, with_usage=True))
+    for _, usage in results:
+        record_llm_call(usage, usage["latency"])
+    return [result for result, _ in results]
+
     
+def stop_speculation(speculation, cancelled):
+    """
+    Stop a speculative exploration whose result is not needed, and wait until it returns.
+
+    `cancelled` is the event the exploration checks between its steps. Waiting keeps it from
+    holding a speculation thread or adding to the stats of a question already saved.
+    """
+    cancelled.set()
+    if not speculation.cancel():
+        wait([speculation])
+
+
+def submit_in_context(executor, func, *args):
+    """Run `func` on `executor` in a copy of the current context, so its LLM calls and time count for the current question."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+_fan_out_executor = None
+
+
+def setup_fan_out(workers):
+    """Threads shared by the fan-out of every question, 1 keeps the search loops serial."""
+    global _fan_out_executor
+    if workers > 1:
+        _fan_out_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fan-out")
+
+
+def fan_out(func, items):
+    """Call `func(*item)` for every item of `items` on the fan-out threads, results come back in the order of `items`."""
+    if _fan_out_executor is None or len(items) <= 1:
+        return [func(*item) for item in items]
+    futures = [submit_in_context(_fan_out_executor, func, *item) for item in items]
+    return [future.result() for future in futures]
+
+
 def all_unknown_entity(entity_candidates):
     return all(candidate == "UnName_Entity" for candidate in entity_candidates)
 
@@ -151,13 +252,35 @@ def clean_scores(string, entity_candidates):
     else:
         print("All entities are created equal.")
         return [1/len(entity_candidates)] * len(entity_candidates)
+
+
+def clean_scores_batch(string, candidates_list):
+    """
+    Split the output of a batched entity scoring prompt into one score list per relation.
+
+    Returns a list aligned with `candidates_list`, holding None for every relation whose
+    numbered score line is missing or does not have one score per candidate.
+    """
+    scores_list = [None] * len(candidates_list)
+    for match in re.finditer(r"^\s*(\d+)\.\s+(.*)$", string, re.M):
+        index = int(match.group(1)) - 1
+        if index < 0 or index >= len(candidates_list) or scores_list[index] is not None:
+            continue
+        scores = [float(number) for number in re.findall(r'\d+(?:\.\d+)?', match.group(2))]
+        if len(scores) == len(candidates_list[index]):
+            scores_list[index] = scores
+    return scores_list
     
 
-def save_2_jsonl(question, answer, cluster_chain_of_entities, file_name):
+def save_2_jsonl(question, answer, cluster_chain_of_entities, file_name, budget_stop=None):
     dict = {"question":question, "results": answer, "reasoning_chains": cluster_chain_of_entities}
-    with open("ToG_{}.jsonl".format(file_name), "a") as outfile:
-        json_str = json.dumps(dict)
-        outfile.write(json_str + "\n")
+    if budget_stop is not None:
+        dict["budget_stop"] = budget_stop
+    stats = current_stats()
+    if stats is not None:
+        dict["stats"] = stats.to_dict()
+        run_stats.add(stats)
+    emit_record(dict, file_name)
 
     
 def extract_answer(text):
@@ -175,12 +298,33 @@ def if_true(prompt):
     return False
 
 
+def negative_verdict(text):
+    """True once the {Yes}/{No} verdict of a sufficiency check has been generated and is not Yes."""
+    return "}" in text and extract_answer(text) != "" and not if_true(extract_answer(text))
+
+
+@track_stage("generate_without_explored_paths")
 def generate_without_explored_paths(question, args):
     prompt = cot_prompt + "\n\nQ: " + question + "\nA:"
     response = run_llm(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type)
     return response
 
 
+def budget_exhausted(args):
+    """Name of the per-question budget (time, calls or tokens) that has run out, None while all of them are left."""
+    stats = current_stats()
+    if stats is None:
+        return None
+    totals = stats.totals()
+    if args.question_time_budget and totals["wall_seconds"] >= args.question_time_budget:
+        return "time"
+    if args.question_call_budget and totals["calls"] >= args.question_call_budget:
+        return "calls"
+    if args.question_token_budget and totals["prompt_tokens"] + totals["completion_tokens"] >= args.question_token_budget:
+        return "tokens"
+    return None
+
+
 def if_finish_list(lst):
     if all(elem == "[FINISH_ID]" for elem in lst):
         return True, []
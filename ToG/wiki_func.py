@@ -4,6 +4,7 @@ import openai
 import re
 import time
 from utils import *
+from frontier import Frontier
 
 def transform_relation(relation):
     relation_without_prefix = relation.replace("wiki.relation.", "").replace("_", " ")
@@ -35,6 +36,7 @@ def clean_relations(string, entity_id, head_relations):
 
 
 def construct_relation_prune_prompt(question, entity_name, total_relations, args):
+    total_relations = fit_relations_to_budget(question, entity_name, total_relations, args.relation_token_budget)
     return extract_relation_prompt_wiki % (args.width, args.width)+question+'\nTopic Entity: '+entity_name+ '\nRelations:\n'+'\n'.join([f"{i}. {item}" for i, item in enumerate(total_relations, start=1)])+'A:'
 
 
@@ -54,7 +56,9 @@ def construct_entity_score_prompt(question, relation, entity_candidates):
     return score_entity_candidates_prompt_wiki.format(question, relation) + "; ".join(entity_candidates) + '\nScore: '
 
 
-def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, question, args, wiki_client):
+@track_stage("relation_search_prune")
+def relation_search(entity_id, pre_relations, pre_head, args, wiki_client):
+    """KG half of `relation_search_prune`: returns the head relations and all the candidate relations of the entity."""
     relations = wiki_client.query_all("get_all_relations_of_an_entity", entity_id)
     head_relations = [rel['label'] for rel in relations['head']]
     tail_relations = [rel['label'] for rel in relations['tail']]
@@ -70,7 +74,11 @@ def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, quest
     tail_relations = list(set(tail_relations))
     total_relations = head_relations+tail_relations
     total_relations.sort()  # make sure the order in prompt is always equal
-    
+    return head_relations, total_relations
+
+
+@track_stage("relation_search_prune")
+def relation_prune(entity_id, entity_name, head_relations, total_relations, question, args):
     prompt = construct_relation_prune_prompt(question, entity_name, total_relations, args)
 
     result = run_llm(prompt, args.temperature_exploration, args.max_length, args.opeani_api_keys, args.LLM_type)
@@ -80,7 +88,46 @@ def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, quest
         return retrieve_relations_with_scores
     else:
         return [] # format error or too small max_length
-    
+
+
+@track_stage("relation_search_prune")
+def relation_search_prune(entity_id, entity_name, pre_relations, pre_head, question, args, wiki_client):
+    head_relations, total_relations = relation_search(entity_id, pre_relations, pre_head, args, wiki_client)
+    return relation_prune(entity_id, entity_name, head_relations, total_relations, question, args)
+
+
+def search_relations(entity_id, entity_name, pre_relations, pre_head, question, args, wiki_client, explored=None):
+    """`relation_search_prune`, reusing what a speculative exploration already fetched for the entity."""
+    if explored is None:
+        return relation_search_prune(entity_id, entity_name, pre_relations, pre_head, question, args, wiki_client)
+    head_relations, total_relations, retrieve_relations_with_scores = explored[entity_id]
+    if retrieve_relations_with_scores is None:
+        retrieve_relations_with_scores = relation_prune(entity_id, entity_name, head_relations, total_relations, question, args)
+    return retrieve_relations_with_scores
+
+
+@track_stage("speculative_exploration")
+def explore_next_depth(entities_id, pre_relations, pre_heads, question, args, wiki_client, cancelled=None):
+    """
+    Start the next depth from the entities kept by `entity_prune`, before the reasoning verdict is known.
+
+    Returns the next topic entities and, for each of them, (head_relations, total_relations,
+    pruned relations). The pruned relations are only computed with the "prune" mode and are
+    None otherwise. The exploration stops early, returning None, once `cancelled` is set.
+    """
+    _, entities_id = if_finish_list(entities_id)
+    topic_entity = {qid: topic for qid, topic in zip(entities_id, [wiki_client.query_all("qid2label", entity).pop() for entity in entities_id])}
+    explored = {}
+    for i, entity in enumerate(topic_entity):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        head_relations, total_relations = relation_search(entity, pre_relations, pre_heads[i], args, wiki_client)
+        if cancelled is not None and cancelled.is_set():
+            return None
+        pruned = relation_prune(entity, topic_entity[entity], head_relations, total_relations, question, args) if args.speculative_exploration == "prune" else None
+        explored[entity] = (head_relations, total_relations, pruned)
+    return topic_entity, explored
+
 
 def del_all_unknown_entity(entity_candidates_id, entity_candidates_name):
     if len(entity_candidates_name) == 1 and entity_candidates_name[0] == "N/A":
@@ -100,6 +147,7 @@ def all_zero(topn_scores):
     return all(score == 0 for score in topn_scores)
 
 
+@track_stage("entity_search")
 def entity_search(entity, relation, wiki_client, head):
     rid = wiki_client.query_all("label2pid", relation)
     if not rid or rid == "Not Found!":
@@ -124,7 +172,53 @@ def entity_search(entity, relation, wiki_client, head):
     return id_list, name_list
 
 
-def entity_score(question, entity_candidates_id, entity_candidates, score, relation, args):
+def _prefetch_batch(entities, wiki_client, skip_relation):
+    relations = wiki_client.query_many("get_all_relations_of_an_entity", [(entity,) for entity in entities])
+    items = [(("get_all_relations_of_an_entity", entity), entity_relations) for entity, entity_relations in zip(entities, relations)]
+    # (entity, relation label, head) of every relation entity_search may be asked for
+    searches = [(entity, rel['label'], head) for entity, entity_relations in zip(entities, relations) if entity_relations != "Not Found!"
+                for head, side in ((True, 'head'), (False, 'tail')) for rel in entity_relations[side] if not skip_relation(rel['label'])]
+    labels = sorted(set(label for _, label, _ in searches))
+    pids = dict(zip(labels, wiki_client.query_many("label2pid", [(label,) for label in labels])))
+    items += [(("label2pid", label), pid) for label, pid in pids.items()]
+    # entity_search uses the pid popped from the set
+    searches = [(entity, next(iter(pids[label])), head) for entity, label, head in searches if pids[label] and pids[label] != "Not Found!"]
+    pairs = sorted(set((entity, pid) for entity, pid, _ in searches))
+    tails = dict(zip(pairs, wiki_client.query_many("get_tail_entities_given_head_and_relation", pairs)))
+    items += [(("get_tail_entities_given_head_and_relation",) + pair, entities_set) for pair, entities_set in tails.items()]
+    # relations without entities on the searched side are values
+    value_pairs = sorted(set((entity, pid) for entity, pid, head in searches if tails[(entity, pid)] == "Not Found!" or not tails[(entity, pid)]['tail' if head else 'head']))
+    values = wiki_client.query_many("get_tail_values_given_head_and_relation", value_pairs)
+    items += [(("get_tail_values_given_head_and_relation",) + pair, entity_values) for pair, entity_values in zip(value_pairs, values)]
+    kg_cache.put_many(items)
+
+
+def prefetch_neighborhoods(entity_ids, wiki_client, batch_size=50, skip_relation=lambda relation: False):
+    """
+    Pull the one-hop relations and neighbours of `entity_ids` into the KG cache with batched XML-RPC calls.
+
+    The lookups made by `relation_search` and `entity_search` for these entities are sent as
+    multicalls, `batch_size` entities at a time. Relations for which `skip_relation` is true
+    (dropped by `relation_search` anyway) are not followed. Entities already in the cache are skipped.
+    """
+    pending = [entity for entity in dict.fromkeys(entity_ids) if kg_cache.get("get_all_relations_of_an_entity", entity) is None]
+    for start in tqdm(range(0, len(pending), batch_size), desc="KG prefetch"):
+        _prefetch_batch(pending[start:start + batch_size], wiki_client, skip_relation)
+    print("KG prefetch: %d topic entities, %d fetched." % (len(set(entity_ids)), len(pending)))
+
+
+def construct_entity_score_batch_prompt(question, relations, entity_candidates_list):
+    groups = ['%d. Relation: %s\nEntites: %s' % (i, relation, "; ".join(entity_candidates)) for i, (relation, entity_candidates) in enumerate(zip(relations, entity_candidates_list), start=1)]
+    return score_entity_candidates_batch_prompt_wiki + question + '\n' + '\n'.join(groups) + '\nScore:\n'
+
+
+def resolve_entity_candidates(entity_candidates_id, entity_candidates, score):
+    """
+    Settle the cases that need no scoring.
+
+    Returns (scores, entity_candidates, entity_candidates_id), scores is None when the
+    candidates still have to be scored, in which case they are sorted by name.
+    """
     if len(entity_candidates) == 1:
         return [score], entity_candidates, entity_candidates_id
     if len(entity_candidates) == 0:
@@ -135,30 +229,68 @@ def entity_score(question, entity_candidates_id, entity_candidates, score, relat
     entity_candidates, entity_candidates_id = zip(*zipped_lists)
     entity_candidates = list(entity_candidates)
     entity_candidates_id = list(entity_candidates_id)
+    return None, entity_candidates, entity_candidates_id
 
-    prompt = construct_entity_score_prompt(question, relation, entity_candidates)
 
-    result = run_llm(prompt, args.temperature_exploration, args.max_length, args.opeani_api_keys, args.LLM_type)
-    entity_scores = clean_scores(result, entity_candidates)
+def weight_entity_scores(entity_scores, entity_candidates, entity_candidates_id, score):
     if all_zero(entity_scores):
         return [1/len(entity_candidates) * score] * len(entity_candidates), entity_candidates, entity_candidates_id
     else:
         return [float(x) * score for x in entity_scores], entity_candidates, entity_candidates_id
 
 
-def update_history(entity_candidates, entity, scores, entity_candidates_id, total_candidates, total_scores, total_relations, total_entities_id, total_topic_entities, total_head, value_flag):
+@track_stage("entity_score")
+def entity_score(question, entity_candidates_id, entity_candidates, score, relation, args):
+    scores, entity_candidates, entity_candidates_id = resolve_entity_candidates(entity_candidates_id, entity_candidates, score)
+    if scores is not None:
+        return scores, entity_candidates, entity_candidates_id
+    return score_entity_candidates(question, entity_candidates, entity_candidates_id, score, relation, args)
+
+
+def score_entity_candidates(question, entity_candidates, entity_candidates_id, score, relation, args):
+    prompt = construct_entity_score_prompt(question, relation, entity_candidates)
+
+    result = run_llm(prompt, args.temperature_exploration, args.max_length, args.opeani_api_keys, args.LLM_type)
+    entity_scores = clean_scores(result, entity_candidates)
+    return weight_entity_scores(entity_scores, entity_candidates, entity_candidates_id, score)
+
+
+@track_stage("entity_score")
+def entity_score_batch(question, entity_candidates_id_list, entity_candidates_list, score_list, relation_list, args):
+    """
+    Score the candidates of all relations of a depth with a single LLM call.
+
+    Returns one (scores, entity_candidates, entity_candidates_id) per relation, in input order.
+    Relations whose scores cannot be parsed from the batched output are scored one by one.
+    """
+    results = [resolve_entity_candidates(entity_candidates_id, entity_candidates, score) for entity_candidates_id, entity_candidates, score in zip(entity_candidates_id_list, entity_candidates_list, score_list)]
+    pending = [i for i, (scores, _, _) in enumerate(results) if scores is None]
+    if len(pending) == 1:
+        i = pending[0]
+        results[i] = score_entity_candidates(question, results[i][1], results[i][2], score_list[i], relation_list[i], args)
+    if len(pending) <= 1:
+        return results
+
+    pending_candidates_list = [results[i][1] for i in pending]
+    prompt = construct_entity_score_batch_prompt(question, [relation_list[i] for i in pending], pending_candidates_list)
+    # one line of scores per relation, the explanation after them may be cut off
+    max_tokens = max(args.max_length, 40 * len(pending))
+    result = run_llm(prompt, args.temperature_exploration, max_tokens, args.opeani_api_keys, args.LLM_type)
+    for i, entity_scores in zip(pending, clean_scores_batch(result, pending_candidates_list)):
+        _, entity_candidates, entity_candidates_id = results[i]
+        if entity_scores is None:
+            print("Batched entity scoring failed for relation %s, scoring it alone." % relation_list[i])
+            results[i] = score_entity_candidates(question, entity_candidates, entity_candidates_id, score_list[i], relation_list[i], args)
+        else:
+            results[i] = weight_entity_scores(entity_scores, entity_candidates, entity_candidates_id, score_list[i])
+    return results
+
+
+def update_history(frontier, entity, entity_candidates, scores, entity_candidates_id, value_flag):
     if value_flag:
-        scores = [1/len(entity_candidates) * entity['score']]
-    candidates_relation = [entity['relation']] * len(entity_candidates)
-    topic_entities = [entity['entity']] * len(entity_candidates)
-    head_num = [entity['head']] * len(entity_candidates)
-    total_candidates.extend(entity_candidates)
-    total_scores.extend(scores)
-    total_relations.extend(candidates_relation)
-    total_entities_id.extend(entity_candidates_id)
-    total_topic_entities.extend(topic_entities)
-    total_head.extend(head_num)
-    return total_candidates, total_scores, total_relations, total_entities_id, total_topic_entities, total_head
+        scores = [1/len(entity_candidates) * entity['score']] * len(entity_candidates)
+    frontier.add(entity, entity_candidates, entity_candidates_id, scores)
+    return frontier
 
 
 def half_stop(question, cluster_chain_of_entities, depth, args):
@@ -167,6 +299,16 @@ def half_stop(question, cluster_chain_of_entities, depth, args):
     save_2_jsonl(question, answer, cluster_chain_of_entities, file_name=args.dataset)
 
 
+def budget_stop(question, cluster_chain_of_entities, budget, depth, args):
+    print("The %s budget of the question ran out at depth %d, answering with the knowledge found so far." % (budget, depth))
+    if cluster_chain_of_entities:
+        answer = generate_answer(question, cluster_chain_of_entities, args)
+    else:
+        answer = generate_without_explored_paths(question, args)
+    save_2_jsonl(question, answer, cluster_chain_of_entities, file_name=args.dataset, budget_stop=budget)
+
+
+@track_stage("generate_answer")
 def generate_answer(question, cluster_chain_of_entities, args): 
     prompt = answer_prompt_wiki + question + '\n'
     chain_prompt = '\n'.join([', '.join([str(x) for x in chain]) for sublist in cluster_chain_of_entities for chain in sublist])
@@ -175,28 +317,26 @@ def generate_answer(question, cluster_chain_of_entities, args):
     return result
 
 
-def entity_prune(total_entities_id, total_relations, total_candidates, total_topic_entities, total_head, total_scores, args, wiki_client):
-    zipped = list(zip(total_entities_id, total_relations, total_candidates, total_topic_entities, total_head, total_scores))
-    sorted_zipped = sorted(zipped, key=lambda x: x[5], reverse=True)
-    sorted_entities_id, sorted_relations, sorted_candidates, sorted_topic_entities, sorted_head, sorted_scores = [x[0] for x in sorted_zipped], [x[1] for x in sorted_zipped], [x[2] for x in sorted_zipped], [x[3] for x in sorted_zipped], [x[4] for x in sorted_zipped], [x[5] for x in sorted_zipped]
-
-    entities_id, relations, candidates, topics, heads, scores = sorted_entities_id[:args.width], sorted_relations[:args.width], sorted_candidates[:args.width], sorted_topic_entities[:args.width], sorted_head[:args.width], sorted_scores[:args.width]
-    merged_list = list(zip(entities_id, relations, candidates, topics, heads, scores))
-    filtered_list = [(id, rel, ent, top, hea, score) for id, rel, ent, top, hea, score in merged_list if score != 0]
-    if len(filtered_list) ==0:
+def entity_prune(frontier, args, wiki_client):
+    kept = [candidate for candidate in frontier.top(args.width) if candidate.score != 0]
+    if len(kept) ==0:
         return False, [], [], [], []
-    entities_id, relations, candidates, tops, heads, scores = map(list, zip(*filtered_list))
-    tops = [wiki_client.query_all("qid2label", entity_id).pop() if (entity_name := wiki_client.query_all("qid2label", entity_id)) != "Not Found!" else "Unname_Entity" for entity_id in tops]
-    cluster_chain_of_entities = [[(tops[i], relations[i], candidates[i]) for i in range(len(candidates))]]
-    return True, cluster_chain_of_entities, entities_id, relations, heads
+    names = {topic: entity_name.pop() if (entity_name := wiki_client.query_all("qid2label", topic)) != "Not Found!" else "Unname_Entity" for topic in set(candidate.topic_entity for candidate in kept)}
+    cluster_chain_of_entities = [[(names[candidate.topic_entity], candidate.relation, candidate.name) for candidate in kept]]
+    return True, cluster_chain_of_entities, [candidate.entity_id for candidate in kept], [candidate.relation for candidate in kept], [candidate.head for candidate in kept]
 
 
+@track_stage("reasoning")
 def reasoning(question, cluster_chain_of_entities, args):
     prompt = prompt_evaluate_wiki + question
     chain_prompt = '\n'.join([', '.join([str(x) for x in chain]) for sublist in cluster_chain_of_entities for chain in sublist])
     prompt += "\nKnowledge Triplets: " + chain_prompt + 'A: '
 
-    response = run_llm(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type)
+    if args.stream_reasoning:
+        # a No verdict only needs its first tokens, the explanation after it is thrown away
+        response = run_llm_streaming(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type, negative_verdict)
+    else:
+        response = run_llm(prompt, args.temperature_reasoning, args.max_length, args.opeani_api_keys, args.LLM_type)
     
     result = extract_answer(response)
     if if_true(result):
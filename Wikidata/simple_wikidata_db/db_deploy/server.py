@@ -183,6 +183,7 @@ class XMLRPCWikidataQueryServer(WikidataQueryServer):
         )
         self.server = SimpleXMLRPCServer(addr, requestHandler=requestHandler)
         self.server.register_introspection_functions()
+        self.server.register_multicall_functions()
         self.server.register_function(self.get_all_relations_of_an_entity)
         self.server.register_function(
             self.get_tail_entities_given_head_and_relation